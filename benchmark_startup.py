@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import statistics
+import datapipe
+
+
+# measures how long the simulator takes to start: a fresh interpreter importing driver and
+# loading a small input into a Driver, as a driver.py run does before simulating
+# receives as optional command-line arguments the number of runs and the budget in seconds;
+# exits with status 1 if the median startup time is over the budget
+
+# startup code run in each fresh interpreter
+startup = "import sys, driver; driver.Driver(sys.argv[1])"
+
+# writes a small input file (2 communities of 4 nodes, 10 transactions each) and returns its path
+def writeInput(directory):
+    filename = os.path.join(directory, 'input.txt')
+    with open(filename, 'w') as outfile:
+        datapipe.writeCommunities(outfile, datapipe.run(2, 4, 10, seed=0, workers=1), False)
+    return filename
+
+# returns the wall time of one startup, in seconds
+def timeStartup(filename):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', startup, filename], check=True, stdout=subprocess.DEVNULL,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+# returns the (cumulative microseconds, module) of the slowest imports of one startup, counting the
+# modules imported at the top level and those they import directly
+def slowestImports(filename, count=8):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', startup, filename], check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        # the module column is indented by two spaces per level of nesting
+        if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith('     '):
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    with tempfile.TemporaryDirectory() as directory:
+        filename = writeInput(directory)
+        # the first run warms the bytecode cache and is not counted
+        timeStartup(filename)
+        times = [timeStartup(filename) for i in range(runs)]
+        imports = slowestImports(filename)
+    median = statistics.median(times)
+    print('startup time (sec): median ' + '{:.3f}'.format(median) + ', min ' + '{:.3f}'.format(min(times)) +
+          ', max ' + '{:.3f}'.format(max(times)) + ' over ' + str(runs) + ' runs')
+    print('slowest imports (ms):')
+    for (us, module) in imports:
+        print('  ' + '{:8.1f}'.format(us / 1000) + '  ' + module)
+    if median > budget:
+        print('over budget of ' + str(budget) + ' sec')
+        sys.exit(1)
+
+
+if __name__== "__main__":
+    main()
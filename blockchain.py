@@ -1,90 +1,264 @@
-import sys
-import os
-import copy
-import json
-import numbers
-from hashlib import sha256 as H
-import random
 from collections import defaultdict
-from threading import Thread
-import time
-import nacl.encoding
-import nacl.signing
 import utils
-import mergesplit_node
 import buildingblocks
 
 
+# implements an immutable, content-addressed store of blocks shared by the nodes of a community
+# each block is turned into a BlockNode once, and BlockNodes are never modified after being added
+class BlockStore:
+
+    def __init__(self):
+        # block hash -> BlockNode
+        self.blockToNode = {}
+        # block hash -> number of blocks extending it
+        self.children = defaultdict(int)
+        # BlockNode each branch forked from (None for a genesis), indexed by BlockNode.branch
+        self.forks = []
+        # unspent outputs at the leaves of the store, keyed by the leaf BlockNode
+        self.unspent = {}
+        # outputs and balances of the segment ending at each leaf (see buildingblocks.SegmentOutputs)
+        self.segments = {}
+        # transaction number -> BlockNodes containing it, across all branches
+        self.transactionIndex = defaultdict(list)
+
+    def __contains__(self, blockHash):
+        return blockHash in self.blockToNode
+
+    # returns the BlockNode for a block hash, or None if the block is not stored
+    def get(self, blockHash):
+        return self.blockToNode.get(blockHash)
+
+    # stores a genesis block, returning its BlockNode
+    def addGenesis(self, genesis):
+        blockHash = genesis.getHash()
+        if blockHash in self.blockToNode:
+            return self.blockToNode[blockHash]
+        node = buildingblocks.BlockNode(genesis)
+        node.branch = len(self.forks)
+        self.forks.append(None)
+        unspent = buildingblocks.UnspentOutputs()
+        self._index(node, unspent, buildingblocks.SegmentOutputs())
+        return node
+
+    # stores a block whose prev is already stored, returning its BlockNode
+    # blocks that are already stored are not added again
+    def add(self, block):
+        blockHash = block.getHash()
+        if blockHash in self.blockToNode:
+            return self.blockToNode[blockHash]
+        prevNode = self.blockToNode[block.prev]
+        node = buildingblocks.BlockNode(block, prevNode)
+        if self.children[block.prev] >= 1:
+            # starts a new branch, which gets its own copy of the unspent outputs at prev
+            node.branch = len(self.forks)
+            self.forks.append(prevNode)
+            unspent = self.unspentAt(prevNode)
+            if prevNode in self.unspent:
+                unspent = unspent.copy()
+            if self.isBoundary(node):
+                segment = buildingblocks.SegmentOutputs()
+            else:
+                segment = self.segmentAt(prevNode)
+                if prevNode in self.segments:
+                    segment = segment.copy()
+        else:
+            # extends the branch of prev, updating its unspent outputs in place
+            node.branch = prevNode.branch
+            unspent = self.unspent.pop(prevNode)
+            segment = self.segments.pop(prevNode)
+            if self.isBoundary(node):
+                segment = buildingblocks.SegmentOutputs()
+        self.children[block.prev] += 1
+        self._index(node, unspent, segment)
+        return node
+
+    # records a new BlockNode and applies its transactions to the unspent outputs and its segment
+    def _index(self, node, unspent, segment):
+        for transaction in node.block.getTransactions():
+            unspent.apply(transaction)
+            segment.apply(transaction)
+            self.transactionIndex[transaction.number].append(node)
+        self.unspent[node] = unspent
+        self.segments[node] = segment
+        self.blockToNode[node.block.getHash()] = node
+
+    # checks if a BlockNode starts a segment: a genesis, split or merge block, or the first block of a chain
+    def isBoundary(self, node):
+        block = node.block
+        return block.isGenesis or block.isSplit or block.isMerge or node.prev is None
+
+    # returns the outputs and balances of the segment ending at a BlockNode
+    # leaves are answered from the maintained segments, other nodes are rebuilt from the segment's first block
+    def segmentAt(self, node):
+        if node in self.segments:
+            return self.segments[node]
+        path = [node]
+        while not self.isBoundary(path[-1]):
+            path.append(path[-1].prev)
+        segment = buildingblocks.SegmentOutputs()
+        for current in reversed(path):
+            for transaction in current.block.getTransactions():
+                segment.apply(transaction)
+        return segment
+
+    # returns the unspent outputs as of a BlockNode
+    # leaves are answered from the maintained sets, other nodes are rebuilt from genesis
+    def unspentAt(self, node):
+        if node in self.unspent:
+            return self.unspent[node]
+        path = []
+        while node:
+            path.append(node)
+            node = node.prev
+        unspent = buildingblocks.UnspentOutputs()
+        for current in reversed(path):
+            for transaction in current.block.getTransactions():
+                unspent.apply(transaction)
+        return unspent
+
+    # checks if node lies on the path from tip back to its genesis
+    # climbs the fork points between branches instead of walking blocks
+    def isAncestor(self, node, tip):
+        branch, limit = tip.branch, tip.height
+        while branch != node.branch:
+            fork = self.forks[branch]
+            if fork is None:
+                return False
+            branch, limit = fork.branch, fork.height
+        return node.height <= limit
+
+    # returns the height of the last block shared by the chains ending at a and b (0 if they share none)
+    # climbs the fork points between branches instead of walking blocks
+    # nodes not held by this store (e.g. from another community's store) are walked block by block
+    def forkHeight(self, a, b):
+        if self.get(a.block.getHash()) is not a or self.get(b.block.getHash()) is not b:
+            while a and b and a is not b:
+                if a.height >= b.height:
+                    a = a.prev
+                else:
+                    b = b.prev
+            return a.height if a and b else 0
+        # branch -> height of the last block of that branch on the chain ending at a
+        limits = {}
+        branch, limit = a.branch, a.height
+        while True:
+            limits[branch] = limit
+            fork = self.forks[branch]
+            if fork is None:
+                break
+            branch, limit = fork.branch, fork.height
+        branch, limit = b.branch, b.height
+        while branch not in limits:
+            fork = self.forks[branch]
+            if fork is None:
+                return 0
+            branch, limit = fork.branch, fork.height
+        return min(limit, limits[branch])
+
+    # checks if a transaction number appears on the chain ending at tip
+    # numbers never seen on any branch are rejected by the index lookup alone
+    def containsTransaction(self, number, tip):
+        nodes = self.transactionIndex.get(number)
+        if not nodes:
+            return False
+        for node in nodes:
+            if self.isAncestor(node, tip):
+                return True
+        return False
+
+
 # implements blockchain data structure
+# a node's view of a shared BlockStore: only the tip of each chain it has seen is held here
 class BlockChain:
     
-    def __init__(self):
+    def __init__(self, store=None):
+        self.store = store if store is not None else BlockStore()
+        # tip BlockNode of each chain
         self.chains = []
-        self.blockToIndex = {}
-        self.blockToNode = {}
+        # tip BlockNode -> index in chains
+        self.tipToIndex = {}
         self.longestIndex = 0
         self.longestLength = 0
-        self.parents = defaultdict(int)
+
+    # returns a view with the same chains over the same store
+    def copy(self):
+        chain = BlockChain(self.store)
+        chain.chains = list(self.chains)
+        chain.tipToIndex = dict(self.tipToIndex)
+        chain.longestIndex = self.longestIndex
+        chain.longestLength = self.longestLength
+        return chain
         
     # adds a genesis block to the blockchain
     def setGenesis(self, genesis):
-        front = buildingblocks.BlockNode(genesis)
-        genesisSerialized = H(str.encode(utils.Utils.serializeBlock(genesis))).hexdigest()
-        self.blockToNode[genesisSerialized] = front
-        self.blockToIndex[genesisSerialized] = 0
+        front = self.store.addGenesis(genesis)
+        self.tipToIndex[front] = len(self.chains)
         self.longestLength = 1
         self.chains.append(front)
     
     # adds a block to the blockchain
     # handles forking if block added as new branch from previously seen block
     def addBlock(self, block):
-        # constructs a new BlockNode
-        node = buildingblocks.BlockNode(block, self.blockToNode[block.prev])
-        serialized = H(str.encode(utils.Utils.serializeBlock(block))).hexdigest()
-        self.blockToNode[serialized] = node
-        if self.parents[block.prev] >= 1:
+        prevNode = self.store.blockToNode[block.prev]
+        node = self.store.add(block)
+        if prevNode in self.tipToIndex:
+            # extends an existing chain
+            index = self.tipToIndex.pop(prevNode)
+            self.chains[index] = node
+        else:
             # represents a fork
             self.chains.append(node)
-            self.blockToIndex[serialized] = len(self.chains)-1
-        else:
-            # extends an existing chain
-            self.chains[self.blockToIndex[block.prev]] = node
-            self.blockToIndex[serialized] = self.blockToIndex[block.prev]
-        self.parents[block.prev] += 1
-        current, size = node, 0
-        while current:
-            current = current.prev
-            size += 1
+            index = len(self.chains)-1
+        self.tipToIndex[node] = index
+        size = node.height
         if size > self.longestLength:
             # update the longest length and the index of the longest chain
             self.longestLength = size
-            self.longestIndex = self.blockToIndex[serialized]
+            self.longestIndex = index
     
     # returns pointer to tail of the longest chain
     def longestChain(self):
         return self.chains[self.longestIndex]
 
     def lengthOfLongestChain(self):
-        current, size = self.longestChain(), 0
-        while current:
-            current = current.prev
-            size += 1
-        return size
+        return self.longestChain().height
+
+    # returns the height and digest of the longest chain, which identify it without walking its blocks
+    def longestDigest(self):
+        tip = self.longestChain()
+        return tip.height, tip.digest
+
+    # returns the BlockNode for a block hash
+    def getNode(self, blockHash):
+        return self.store.blockToNode[blockHash]
+
+    # returns the unspent outputs as of a BlockNode
+    def unspentAt(self, node):
+        return self.store.unspentAt(node)
+
+    # checks if a transaction number appears on the chain ending at tip
+    def containsTransaction(self, number, tip):
+        return self.store.containsTransaction(number, tip)
     
-    # checks that a block we want to add has its prev hash pointing to a block that exists
+    # checks that a block we want to add has its prev hash pointing to a block on one of this node's chains
     def isValidPrev(self, prev):
-        return prev in self.blockToNode and prev in self.blockToIndex
+        node = self.store.get(prev)
+        if node is None:
+            return False
+        for tip in self.chains:
+            if self.store.isAncestor(node, tip):
+                return True
+        return False
 
     # logs node's blockchain to a file
     def log(self, filename=None):
         current = self.longestChain()
         output = []
         while current:
-            d = {"tx": H(str.encode(current.block.tx)).hexdigest(), "prev": current.block.prev}
+            d = {"tx": current.block.getMerkleRoot(), "prev": current.block.prev}
             dict(sorted(d.items()))
             output.append(d)
             current = current.prev
         if filename:
-            with open(filename, 'w') as outfile:
-                json.dump(output, outfile, sort_keys=False, indent=4, ensure_ascii=False)
+            utils.Utils.codec.writeLog(filename, [(d["tx"], d["prev"]) for d in output])
         return output
\ No newline at end of file
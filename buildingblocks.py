@@ -1,36 +1,325 @@
-import sys
-import os
+from collections import namedtuple, OrderedDict
+from hashlib import sha256 as H
+import utils
 
 
 # implements basic building block classes
+# an input spends the output (value, pubkey) of the transaction with the given number
+Input = namedtuple('Input', ['number', 'value', 'pubkey'])
+# an output pays value to pubkey
+Output = namedtuple('Output', ['value', 'pubkey'])
+
 # represents a transaction
+# inputs and outputs are tuples of Input and Output records (see utils.Utils.transactionFromJson
+# and transactionToJson for the JSON form)
 class Transaction:
+    __slots__ = ('number', 'inp', 'out', 'sig', 'message')
+
     def __init__(self, number, inp, out, sig):
         self.number = number
         self.inp = inp
         self.out = out
         self.sig = sig
+        # bytes signed by the sender, filled in on first use
+        self.message = None
+
+    # returns the canonical message (serialized inputs then outputs) that the sender signs
+    def getMessage(self):
+        if self.message is None:
+            serializedInput = "".join([str(inp.number) + str(inp.value) + str(inp.pubkey) for inp in self.inp])
+            serializedOutput = "".join([str(out.value) + str(out.pubkey) for out in self.out])
+            self.message = str.encode(serializedInput + serializedOutput)
+        return self.message
 
-# represents a block, contains a single transaction for simplicity
+# represents a block, contains a list of serialized transactions (txs, encoded by utils.Utils.codec)
 # each block references a prev block, has an isGenesis flag,
-# and a flag indicating if the internal transaction is a mergesplit fee
+# and a flag indicating if the internal transactions are a mergesplit fee
 class Block:
-    def __init__(self, tx, prev, isGenesis=False, isFee=False, isSplit=False, isMerge=False, mergePrev2 = None):
-        self.tx = tx
+    __slots__ = ('txs', 'prev', 'isGenesis', 'isFee', 'isSplit', 'isMerge', 'mergePrev2',
+                 'transactions', 'merkleRoot', 'hash')
+
+    # shared utils.LRUCache of decoded transactions keyed by serialized transaction
+    # when set, blocks stop holding their own decoded transactions (for capped memory)
+    transactionCache = None
+
+    def __init__(self, txs, prev, isGenesis=False, isFee=False, isSplit=False, isMerge=False, mergePrev2 = None):
+        self.txs = txs
         self.prev = prev
         self.isGenesis = isGenesis
         self.isFee = isFee
         self.isSplit = isSplit
         self.isMerge = isMerge
         self.mergePrev2 = mergePrev2
+        # decoded transactions, filled in on first use
+        self.transactions = None
+        # merkle root of txs, filled in on first use
+        self.merkleRoot = None
+        # hash of the serialized block header, filled in on first use
+        self.hash = None
+
+    # returns the decoded transactions in block order, so each block's transactions are decoded once
+    def getTransactions(self):
+        cache = Block.transactionCache
+        if cache is None:
+            if self.transactions is None:
+                self.transactions = [utils.Utils.deserializeTransaction(tx) for tx in self.txs]
+            return self.transactions
+        transactions = []
+        for tx in self.txs:
+            transaction = cache.get(tx)
+            if transaction is None:
+                transaction = utils.Utils.deserializeTransaction(tx)
+                cache.put(tx, transaction)
+            transactions.append(transaction)
+        return transactions
+
+    # records the decoded transactions of a block built from transactions already in hand,
+    # so that they are not decoded again
+    def setTransactions(self, transactions):
+        cache = Block.transactionCache
+        if cache is None:
+            self.transactions = list(transactions)
+            return
+        for tx, transaction in zip(self.txs, transactions):
+            cache.put(tx, transaction)
+
+    # returns the merkle root of the block's transactions
+    # a single transaction's root is the hash of that transaction
+    # the last hash of an odd level moves up unpaired rather than being paired with itself, which would
+    # give [a, b, c] and [a, b, c, c] the same root (and blocks with different transactions the same hash)
+    def getMerkleRoot(self):
+        if self.merkleRoot is None:
+            level = [H(tx).hexdigest() for tx in self.txs]
+            while len(level) > 1:
+                paired = [H(str.encode(level[i] + level[i+1])).hexdigest() for i in range(0, len(level) - 1, 2)]
+                level = paired + level[-1:] if len(level) % 2 == 1 else paired
+            self.merkleRoot = level[0]
+        return self.merkleRoot
+
+    # returns the hash identifying this block, computed once from its header (merkle root and prev)
+    def getHash(self):
+        if self.hash is None:
+            self.hash = H(utils.Utils.serializeBlockHeader(self)).hexdigest()
+        return self.hash
     
     # can only change prev if is genesis block and new block is merge
     def changePrev(self, newPrev):
         if self.isGenesis and newPrev.isMerge:
             self.prev = newPrev
+            self.hash = None
 
 # represents each BlockNode in the BlockChain
+# height counts blocks from the genesis (which has height 1)
+# branch is the index of the chain the node was added to in its BlockChain
+# digest accumulates the block hashes from the genesis up to this node, so two chains
+# are the same exactly when their tips have the same height and digest
 class BlockNode:
+    __slots__ = ('block', 'prev', 'height', 'branch', 'digest')
+
     def __init__(self, block=None, prev=None):
         self.block = block
-        self.prev = prev
\ No newline at end of file
+        self.prev = prev
+        self.height = prev.height + 1 if prev else 1
+        self.branch = 0
+        self.digest = H((prev.digest if prev else b'') + str.encode(block.getHash())).digest() if block else None
+
+# represents the unspent outputs visible from a chain tip
+# maps each transaction number to a count of its unspent (value, pubkey) outputs
+class UnspentOutputs:
+    __slots__ = ('outputs',)
+
+    def __init__(self, outputs=None):
+        self.outputs = outputs if outputs is not None else {}
+
+    # returns an independent copy for a new fork
+    def copy(self):
+        return UnspentOutputs({number: dict(outs) for number, outs in self.outputs.items()})
+
+    # spends the inputs of a transaction and adds its outputs
+    def apply(self, transaction):
+        for inp in transaction.inp:
+            self.spend(inp.number, inp.value, inp.pubkey)
+        if transaction.out:
+            outs = self.outputs.setdefault(transaction.number, {})
+            for out in transaction.out:
+                outs[out] = outs.get(out, 0) + 1
+
+    # removes a single output, ignoring outputs that are not tracked (e.g. merge inputs from another chain)
+    def spend(self, number, value, pubkey):
+        outs = self.outputs.get(number)
+        if not outs:
+            return
+        key = (value, pubkey)
+        count = outs.get(key, 0)
+        if count > 1:
+            outs[key] = count - 1
+        elif count == 1:
+            del outs[key]
+            if not outs:
+                del self.outputs[number]
+
+    # checks if a particular output is unspent
+    def contains(self, number, value, pubkey):
+        outs = self.outputs.get(number)
+        return bool(outs) and outs.get((value, pubkey), 0) > 0
+
+    # checks that a list of inputs can be spent together without reusing an output
+    def canSpend(self, inputs):
+        needed = {}
+        for inp in inputs:
+            needed[inp] = needed.get(inp, 0) + 1
+        for inp, count in needed.items():
+            outs = self.outputs.get(inp.number)
+            if not outs or outs.get((inp.value, inp.pubkey), 0) < count:
+                return False
+        return True
+
+# represents the outputs and balances of a chain segment: the blocks from the last genesis, split or merge block
+# (or the first block of the chain) up to a tip, the part of the chain a merge or split settles
+# outputs maps each transaction number to its unspent outputs, in transaction and output order
+# balances maps each pubkey to its received minus spent value in the segment, most recently touched first
+# unmatched counts inputs that spend an output not created (or already spent) in the segment
+class SegmentOutputs:
+    __slots__ = ('outputs', 'balances', 'unmatched')
+
+    def __init__(self):
+        self.outputs = {}
+        self.balances = OrderedDict()
+        self.unmatched = 0
+
+    # returns an independent copy for a new fork
+    def copy(self):
+        segment = SegmentOutputs()
+        segment.outputs = {number: list(outs) for number, outs in self.outputs.items()}
+        segment.balances = OrderedDict(self.balances)
+        segment.unmatched = self.unmatched
+        return segment
+
+    # spends the inputs of a transaction and adds its outputs
+    def apply(self, transaction):
+        touched = []
+        for inp in transaction.inp:
+            outs = self.outputs.get(inp.number)
+            out = Output(inp.value, inp.pubkey)
+            if outs and out in outs:
+                # the first of identical outputs is the one spent
+                outs.remove(out)
+                if not outs:
+                    del self.outputs[inp.number]
+            else:
+                self.unmatched += 1
+            self.balances[inp.pubkey] = self.balances.get(inp.pubkey, 0) - inp.value
+            touched.append(inp.pubkey)
+        if transaction.out:
+            self.outputs[transaction.number] = list(transaction.out)
+        for out in transaction.out:
+            self.balances[out.pubkey] = self.balances.get(out.pubkey, 0) + out.value
+            touched.append(out.pubkey)
+        # the transaction's pubkeys become the most recently touched, in the order they appear in it
+        for pubkey in reversed(touched):
+            self.balances.move_to_end(pubkey, last=False)
+
+    # returns (number, value, pubkey) for each unspent output, latest transaction first
+    def unspent(self):
+        return [(number, out.value, out.pubkey)
+                for number in reversed(self.outputs) for out in self.outputs[number]]
+
+# samples nodes with probability proportional to their stake
+# keeps the stakes in a Fenwick tree, so a stake change or a sample costs O(log n) instead of
+# rebuilding the whole distribution; stakes change through update, never by reading node.stake again
+class StakeSampler:
+    __slots__ = ('nodes', 'positions', 'tree', 'total')
+
+    def __init__(self, nodes=()):
+        self.nodes = list(nodes)
+        # node -> index in nodes
+        self.positions = {node: i for i, node in enumerate(self.nodes)}
+        # tree[i] holds the stakes of nodes (i - lowbit(i), i], counted from 1
+        self.tree = [0] + [node.stake for node in self.nodes]
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+        self.total = sum(node.stake for node in self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    # returns the total stake of the first i nodes
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    # adds a node with its current stake
+    def add(self, node):
+        i = len(self.tree)
+        self.positions[node] = len(self.nodes)
+        self.nodes.append(node)
+        self.tree.append(node.stake + self.prefix(i-1) - self.prefix(i - (i & -i)))
+        self.total += node.stake
+
+    # records a change of a node's stake, ignoring nodes that are not sampled
+    def update(self, node, delta):
+        position = self.positions.get(node)
+        if position is None:
+            return
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    # returns the node whose stake interval contains u * total, for u uniform in [0, 1)
+    # (the node np.random.choice picks for the same u and stake proportions)
+    def sample(self, u):
+        target = u * self.total
+        position, step = 0, 1 << (len(self.nodes).bit_length() - 1)
+        while step:
+            if position + step <= len(self.nodes) and self.tree[position + step] <= target:
+                position += step
+                target -= self.tree[position]
+            step >>= 1
+        return self.nodes[min(position, len(self.nodes)-1)]
+
+# a community's features as the mergesplit models see them: number of nodes, length of longest chain,
+# number of forks and total stake of its forgers
+Metrics = namedtuple('Metrics', ['numberOfNodes', 'longestChain', 'numberOfForks', 'totalStake'])
+
+# keeps a community's Metrics up to date as nodes join, blocks are added and stakes change, so reading
+# them costs O(1) instead of a pass over every node's chains
+# snapshot is replaced, never modified, so readers on other threads always see a consistent Metrics
+class CommunityMetrics:
+    __slots__ = ('snapshot',)
+
+    def __init__(self, nodes=()):
+        self.refresh(nodes)
+
+    # recomputes the metrics from the nodes
+    def refresh(self, nodes):
+        longestChain, numberOfForks, totalStake = 0, 0, 0
+        for node in nodes:
+            longestChain = max(longestChain, node.chain.longestLength)
+            numberOfForks = max(numberOfForks, len(node.chain.chains))
+            totalStake += node.stake
+        self.snapshot = Metrics(len(nodes), longestChain, numberOfForks, totalStake)
+
+    # records a node joining with its chain and stake
+    def addNode(self, node):
+        snapshot = self.snapshot
+        self.snapshot = Metrics(snapshot.numberOfNodes + 1, max(snapshot.longestChain, node.chain.longestLength),
+                                max(snapshot.numberOfForks, len(node.chain.chains)), snapshot.totalStake + node.stake)
+
+    # records a block added to a node's chain
+    def addBlock(self, chain):
+        snapshot = self.snapshot
+        if chain.longestLength > snapshot.longestChain or len(chain.chains) > snapshot.numberOfForks:
+            self.snapshot = snapshot._replace(longestChain=max(snapshot.longestChain, chain.longestLength),
+                                              numberOfForks=max(snapshot.numberOfForks, len(chain.chains)))
+
+    # records a change of a node's stake
+    def updateStake(self, delta):
+        if delta:
+            self.snapshot = self.snapshot._replace(totalStake=self.snapshot.totalStake + delta)
@@ -0,0 +1,98 @@
+import os
+import gzip
+import queue
+from collections import Counter
+from threading import Thread
+import utils
+
+
+# implements a compact log of a community's blockchains
+# nodes of a community mostly agree, so the log stores the canonical chain (the longest chain tip held by
+# the most nodes) once, and for each node whose longest chain differs only the blocks above the point
+# where it forks from the canonical chain
+# entries are (merkle root, prev) pairs, tip first, as in BlockChain.log
+
+# returns the file a community's log is written to under root
+def filename(root, community, codec=None, compress=False):
+    codec = codec or utils.Utils.codec
+    return (root + "/community" + str(community.id) + "/blockchains" + codec.extension +
+            ('.gz' if compress else ''))
+
+# yields the entries of the chain from node down to (but excluding) the node at height stop
+def entries(node, stop=0):
+    while node and node.height > stop:
+        yield (node.block.getMerkleRoot(), node.block.prev)
+        node = node.prev
+
+# returns the canonical tip of a community and the (node, fork height, tip) of each node that diverges
+# from it, nodes numbered from 1 as in the per-node log files
+def divergences(community):
+    tips = [node.chain.longestChain() for node in community.nodes]
+    counts = Counter(tips)
+    canonical = max(counts, key=lambda tip: (counts[tip], tip.height))
+    return canonical, [(i+1, community.store.forkHeight(tip, canonical), tip)
+                       for i, tip in enumerate(tips) if tip is not canonical]
+
+# writes a community's log to a file, streaming entries as the chains are walked
+def write(path, community, codec=None, compress=False):
+    codec = codec or utils.Utils.codec
+    canonical, diverged = divergences(community)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as outfile:
+        codec.writeChainLog(outfile, len(community.nodes), (canonical.height, entries(canonical)),
+                            [(node, fork, tip.height - fork, entries(tip, fork)) for (node, fork, tip) in diverged])
+
+# reads a community's log back into the log of each node's longest chain, in node order
+def read(path, codec=None):
+    codec = codec or utils.Utils.codec
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as infile:
+        nodeCount, chain, diverged = codec.readChainLog(infile)
+    chains = [chain] * nodeCount
+    for (node, fork, tip) in diverged:
+        chains[node-1] = tip + chain[len(chain)-fork:]
+    return chains
+
+
+# writes community logs on a background thread, so logging overlaps with the caller's own work
+# communities must not change once submitted
+class Writer:
+
+    # gzip the log files
+    compress = False
+    # communities waiting to be written before submit blocks
+    queueSize = 64
+
+    def __init__(self, root, codec=None):
+        self.root = root
+        self.codec = codec or utils.Utils.codec
+        self.queue = queue.Queue(Writer.queueSize)
+        self.error = None
+        self.paths = []
+        self.thread = Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    # queues a community to be logged, returning the file it will be written to
+    def submit(self, community):
+        path = filename(self.root, community, self.codec, Writer.compress)
+        self.paths.append(path)
+        self.queue.put((path, community))
+        return path
+
+    # waits until every submitted community is written, raising the first error met
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            try:
+                write(item[0], item[1], self.codec, Writer.compress)
+            except Exception as e:
+                self.error = e
@@ -0,0 +1,319 @@
+import json
+import struct
+
+# buildingblocks and utils are imported inside the methods that use them: utils creates its codec while it
+# is being imported, so importing it here would make `import codec` fail when codec is imported first
+
+
+# implements the original JSON encoding of transactions, block headers and blocks
+# kept for compatibility: its .json logs match those of earlier versions for chains of one-transaction blocks;
+# block hashes do not, as blocks are now hashed through a header holding their merkle root
+class JsonCodec:
+
+    # file extension of logged blockchains
+    extension = '.json'
+
+    def encodeTransaction(self, transaction):
+        import utils
+        return str.encode(json.dumps({'data': [transaction.number, utils.Utils.inputsToJson(transaction.inp),
+                                               utils.Utils.outputsToJson(transaction.out), transaction.sig]}))
+
+    def decodeTransaction(self, data):
+        import buildingblocks
+        import utils
+        wrapped = json.loads(data)['data']
+        return buildingblocks.Transaction(wrapped[0], utils.Utils.inputsFromJson(wrapped[1]),
+                                          utils.Utils.outputsFromJson(wrapped[2]), wrapped[3])
+
+    def encodeHeader(self, merkleRoot, prev):
+        return str.encode(json.dumps({'data': [merkleRoot, prev]}))
+
+    def encodeBlock(self, block):
+        return str.encode(json.dumps({'data': [[bytes.decode(tx) for tx in block.txs], block.prev]}))
+
+    def decodeBlock(self, data):
+        import buildingblocks
+        wrapped = json.loads(data)['data']
+        return buildingblocks.Block([str.encode(tx) for tx in wrapped[0]], wrapped[1])
+
+    # writes (merkle root, prev) entries of a chain, tip first
+    def writeLog(self, filename, entries):
+        output = [{"tx": merkleRoot, "prev": prev} for (merkleRoot, prev) in entries]
+        with open(filename, 'w') as outfile:
+            json.dump(output, outfile, sort_keys=False, indent=4, ensure_ascii=False)
+
+    # streams a community's chain log (see chainlog.py) to a binary file as one JSON object,
+    # one (merkle root, prev) entry per line
+    # chain is (length, entries) and divergences a list of (node, fork height, length, entries)
+    def writeChainLog(self, outfile, nodeCount, chain, divergences):
+        outfile.write(str.encode('{"nodes": ' + json.dumps(nodeCount) + ',\n"chain": ['))
+        self._writeEntries(outfile, chain[1])
+        outfile.write(b'],\n"divergences": [')
+        for k, (node, forkHeight, length, entries) in enumerate(divergences):
+            outfile.write(str.encode((',' if k else '') + '\n{"node": ' + json.dumps(node) +
+                                     ', "forkHeight": ' + json.dumps(forkHeight) + ', "chain": ['))
+            self._writeEntries(outfile, entries)
+            outfile.write(b']}')
+        outfile.write(b']}\n')
+
+    def _writeEntries(self, outfile, entries):
+        for k, (merkleRoot, prev) in enumerate(entries):
+            outfile.write(str.encode((',' if k else '') + '\n' + json.dumps({"tx": merkleRoot, "prev": prev})))
+
+    # returns (node count, chain entries, [(node, fork height, entries)]) from a chain log
+    def readChainLog(self, infile):
+        log = json.loads(infile.read())
+        entries = lambda chain: [(d["tx"], d["prev"]) for d in chain]
+        return (log["nodes"], entries(log["chain"]),
+                [(d["node"], d["forkHeight"], entries(d["chain"])) for d in log["divergences"]])
+
+
+# implements a compact, canonical binary encoding of transactions, block headers and blocks
+# hex strings (hashes, public keys, signatures) are stored as raw bytes and values as fixed-width numbers;
+# anything else falls back to tagged text, so every value decodes back to exactly what was encoded
+class BinaryCodec:
+
+    # file extension of logged blockchains
+    extension = '.bin'
+
+    # field tags: raw 32 byte hex (hashes and keys), raw 64 byte hex (signatures),
+    # other raw hex, UTF-8 text, and None
+    HASH, SIGNATURE, HEX, TEXT, NONE = 0, 1, 2, 3, 4
+    # value tags: 64 bit int, 64 bit float, bool, and ints too large for 64 bits (as decimal text)
+    INT, FLOAT, BOOL, BIGINT = 0, 1, 2, 3
+    # layouts of a transaction's inputs or outputs
+    COLUMNS, FIELDS = 0, 1
+    hexDigits = frozenset('0123456789abcdef')
+    count = struct.Struct('>I')
+    int64 = struct.Struct('>Bq')
+    float64 = struct.Struct('>Bd')
+
+    def _field(self, out, s):
+        if s is None:
+            out.append(BinaryCodec.NONE)
+            return
+        n = len(s)
+        if n % 2 == 0 and n <= 0x1fffe and BinaryCodec.hexDigits.issuperset(s):
+            if n == 64:
+                out.append(BinaryCodec.HASH)
+            elif n == 128:
+                out.append(BinaryCodec.SIGNATURE)
+            else:
+                out.append(BinaryCodec.HEX)
+                out += struct.pack('>H', n // 2)
+            out += bytes.fromhex(s)
+        else:
+            data = str.encode(s)
+            out.append(BinaryCodec.TEXT)
+            out += BinaryCodec.count.pack(len(data))
+            out += data
+
+    def _readField(self, data, i):
+        tag = data[i]
+        if tag == BinaryCodec.HASH:
+            return data[i+1:i+33].hex(), i + 33
+        if tag == BinaryCodec.SIGNATURE:
+            return data[i+1:i+65].hex(), i + 65
+        if tag == BinaryCodec.HEX:
+            n = struct.unpack_from('>H', data, i+1)[0]
+            return data[i+3:i+3+n].hex(), i + 3 + n
+        if tag == BinaryCodec.TEXT:
+            n = BinaryCodec.count.unpack_from(data, i+1)[0]
+            return bytes.decode(data[i+5:i+5+n]), i + 5 + n
+        if tag == BinaryCodec.NONE:
+            return None, i + 1
+        raise ValueError('Unknown field tag ' + str(tag))
+
+    def _value(self, out, v):
+        if type(v) is int and -(1 << 63) <= v < (1 << 63):
+            out += BinaryCodec.int64.pack(BinaryCodec.INT, v)
+        elif type(v) is float:
+            out += BinaryCodec.float64.pack(BinaryCodec.FLOAT, v)
+        elif type(v) is bool:
+            out += bytes([BinaryCodec.BOOL, v])
+        else:
+            data = str.encode(str(v))
+            out.append(BinaryCodec.BIGINT)
+            out += BinaryCodec.count.pack(len(data))
+            out += data
+
+    def _readValue(self, data, i):
+        tag = data[i]
+        if tag == BinaryCodec.INT:
+            return BinaryCodec.int64.unpack_from(data, i)[1], i + 9
+        if tag == BinaryCodec.FLOAT:
+            return BinaryCodec.float64.unpack_from(data, i)[1], i + 9
+        if tag == BinaryCodec.BOOL:
+            return bool(data[i+1]), i + 2
+        if tag == BinaryCodec.BIGINT:
+            n = BinaryCodec.count.unpack_from(data, i+1)[0]
+            return int(data[i+5:i+5+n]), i + 5 + n
+        raise ValueError('Unknown value tag ' + str(tag))
+
+    # packs a column of 64 character hex strings into raw 32 byte values, or returns None if any is not one
+    def _hashColumn(self, strings):
+        if set(map(type, strings)) - {str} or set(map(len, strings)) - {64}:
+            return None
+        joined = ''.join(strings)
+        try:
+            raw = bytes.fromhex(joined)
+        except ValueError:
+            return None
+        # fromhex also accepts upper case and whitespace, which would not decode back to the same string
+        return raw if raw.hex() == joined else None
+
+    # packs a column of values as 64 bit ints, or returns None if any is not one
+    def _intColumn(self, values):
+        if set(map(type, values)) - {int}:
+            return None
+        try:
+            return struct.pack('>%dq' % len(values), *values)
+        except struct.error:
+            return None
+
+    # splits raw 32 byte values back into hex strings
+    def _readHashColumn(self, data, i, n):
+        h = data[i:i+32*n].hex()
+        return [h[k:k+64] for k in range(0, 64*n, 64)], i + 32*n
+
+    # transaction: number, inputs, outputs, sig
+    # inputs and outputs start with their count and a layout byte: COLUMNS when every number and pubkey
+    # is a 32 byte hex string and every value a 64 bit int, stored as one column per field
+    # (numbers, values, pubkeys), otherwise FIELDS with each input/output's fields tagged in turn
+    def encodeTransaction(self, transaction):
+        out = bytearray()
+        self._field(out, transaction.number)
+        inp = transaction.inp
+        out += BinaryCodec.count.pack(len(inp))
+        numbers = self._hashColumn([i.number for i in inp])
+        values = self._intColumn([i.value for i in inp])
+        pubkeys = self._hashColumn([i.pubkey for i in inp])
+        if numbers is not None and values is not None and pubkeys is not None:
+            out.append(BinaryCodec.COLUMNS)
+            out += numbers
+            out += values
+            out += pubkeys
+        else:
+            out.append(BinaryCodec.FIELDS)
+            for i in inp:
+                self._field(out, i.number)
+                self._value(out, i.value)
+                self._field(out, i.pubkey)
+        outputs = transaction.out
+        out += BinaryCodec.count.pack(len(outputs))
+        values = self._intColumn([o.value for o in outputs])
+        pubkeys = self._hashColumn([o.pubkey for o in outputs])
+        if values is not None and pubkeys is not None:
+            out.append(BinaryCodec.COLUMNS)
+            out += values
+            out += pubkeys
+        else:
+            out.append(BinaryCodec.FIELDS)
+            for o in outputs:
+                self._value(out, o.value)
+                self._field(out, o.pubkey)
+        self._field(out, transaction.sig)
+        return bytes(out)
+
+    def decodeTransaction(self, data):
+        import buildingblocks
+        number, i = self._readField(data, 0)
+        inp = []
+        n, layout, i = BinaryCodec.count.unpack_from(data, i)[0], data[i+4], i + 5
+        if layout == BinaryCodec.COLUMNS:
+            numbers, i = self._readHashColumn(data, i, n)
+            values, i = struct.unpack_from('>%dq' % n, data, i), i + 8*n
+            pubkeys, i = self._readHashColumn(data, i, n)
+            inp = list(map(buildingblocks.Input, numbers, values, pubkeys))
+        else:
+            for k in range(n):
+                inputNumber, i = self._readField(data, i)
+                value, i = self._readValue(data, i)
+                pubkey, i = self._readField(data, i)
+                inp.append(buildingblocks.Input(inputNumber, value, pubkey))
+        out = []
+        n, layout, i = BinaryCodec.count.unpack_from(data, i)[0], data[i+4], i + 5
+        if layout == BinaryCodec.COLUMNS:
+            values, i = struct.unpack_from('>%dq' % n, data, i), i + 8*n
+            pubkeys, i = self._readHashColumn(data, i, n)
+            out = list(map(buildingblocks.Output, values, pubkeys))
+        else:
+            for k in range(n):
+                value, i = self._readValue(data, i)
+                pubkey, i = self._readField(data, i)
+                out.append(buildingblocks.Output(value, pubkey))
+        sig, i = self._readField(data, i)
+        return buildingblocks.Transaction(number, tuple(inp), tuple(out), sig)
+
+    def encodeHeader(self, merkleRoot, prev):
+        out = bytearray()
+        self._field(out, merkleRoot)
+        self._field(out, prev)
+        return bytes(out)
+
+    # block: prev, transaction count, then each transaction prefixed by its length
+    def encodeBlock(self, block):
+        out = bytearray()
+        self._field(out, block.prev)
+        out += BinaryCodec.count.pack(len(block.txs))
+        for tx in block.txs:
+            out += BinaryCodec.count.pack(len(tx))
+            out += tx
+        return bytes(out)
+
+    def decodeBlock(self, data):
+        import buildingblocks
+        prev, i = self._readField(data, 0)
+        txs = []
+        n, i = BinaryCodec.count.unpack_from(data, i)[0], i + 4
+        for k in range(n):
+            length, i = BinaryCodec.count.unpack_from(data, i)[0], i + 4
+            txs.append(bytes(data[i:i+length]))
+            i += length
+        return buildingblocks.Block(txs, prev)
+
+    # writes (merkle root, prev) entries of a chain, tip first, as an entry count then encoded headers
+    def writeLog(self, filename, entries):
+        with open(filename, 'wb') as outfile:
+            outfile.write(BinaryCodec.count.pack(len(entries)))
+            for (merkleRoot, prev) in entries:
+                outfile.write(self.encodeHeader(merkleRoot, prev))
+
+    # streams a community's chain log (see chainlog.py) to a binary file: the node count, the chain's length
+    # and encoded headers, then the number of divergences, each as node, fork height, length and encoded headers
+    # chain is (length, entries) and divergences a list of (node, fork height, length, entries)
+    def writeChainLog(self, outfile, nodeCount, chain, divergences):
+        outfile.write(BinaryCodec.count.pack(nodeCount))
+        self._writeEntries(outfile, *chain)
+        outfile.write(BinaryCodec.count.pack(len(divergences)))
+        for (node, forkHeight, length, entries) in divergences:
+            outfile.write(BinaryCodec.count.pack(node))
+            outfile.write(BinaryCodec.count.pack(forkHeight))
+            self._writeEntries(outfile, length, entries)
+
+    def _writeEntries(self, outfile, length, entries):
+        outfile.write(BinaryCodec.count.pack(length))
+        for (merkleRoot, prev) in entries:
+            outfile.write(self.encodeHeader(merkleRoot, prev))
+
+    # returns (node count, chain entries, [(node, fork height, entries)]) from a chain log
+    def readChainLog(self, infile):
+        data = infile.read()
+        nodeCount, i = BinaryCodec.count.unpack_from(data, 0)[0], 4
+        chain, i = self._readEntries(data, i)
+        divergences = []
+        n, i = BinaryCodec.count.unpack_from(data, i)[0], i + 4
+        for k in range(n):
+            node, forkHeight = BinaryCodec.count.unpack_from(data, i)[0], BinaryCodec.count.unpack_from(data, i+4)[0]
+            entries, i = self._readEntries(data, i + 8)
+            divergences.append((node, forkHeight, entries))
+        return nodeCount, chain, divergences
+
+    def _readEntries(self, data, i):
+        entries = []
+        n, i = BinaryCodec.count.unpack_from(data, i)[0], i + 4
+        for k in range(n):
+            merkleRoot, i = self._readField(data, i)
+            prev, i = self._readField(data, i)
+            entries.append((merkleRoot, prev))
+        return entries, i
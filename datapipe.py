@@ -2,39 +2,39 @@ import sys
 import os
 import time
 import json
-import numbers
+import gzip
+import multiprocessing
+from collections import defaultdict
 from hashlib import sha256 as H
 import random
-from random import choice
 import nacl.signing
 import nacl.encoding
-from nacl.public import PrivateKey
-from utils import Utils
-from mergesplit_node import Node
-from mergesplit_community import Community
-from buildingblocks import Transaction, Block
+import nacl.bindings
 
 
 MAX_TRANSACTION_THRESHOLD = 100
 MAX_INPUT_LIMIT = 1e6
 
 # utility class to generate input data conformant to MergeSplit analysis
-def split_money(target, nodeLimit):
-    numberNodes = random.randint(1, nodeLimit)
+# every community draws from its own random generator (rng), seeded from the run's seed and
+# the community's index, so output is reproducible from the seed however communities are spread over processes
+def split_money(target, nodeLimit, rng):
+    numberNodes = rng.randint(1, nodeLimit)
     remaining = target
     result = []
     while remaining > 0 and len(result) < nodeLimit-1:
-        remove = random.randint(1, remaining)
+        remove = rng.randint(1, remaining)
         result.append(remove)
         remaining -= remove
     if remaining > 0:
         result.append(remaining)
     return result
 
-def generateKeys(totalNodes):
+def generateKeys(totalNodes, rng):
     pubkeys, prikeys = [], []
     for i in range(totalNodes):
-        prikey = nacl.signing.SigningKey.generate()
+        # derive the signing key from the community's generator so keys are reproducible too
+        prikey = nacl.signing.SigningKey(rng.getrandbits(256).to_bytes(32, 'big'))
         # Obtain the verify key for a given signing key
         pubkey = prikey.verify_key
         # Serialize the verify key to send it to a third party
@@ -46,96 +46,144 @@ def generateKeys(totalNodes):
         pubkeyMap[pubkeys[i]] = i
     return pubkeys, prikeys, pubkeyMap
 
-def createGenesisTransaction(transactionList, result, pubkeys):
+def createGenesisTransaction(result, pubkeys, rng):
     inp, out = [], []
     for pubkey in pubkeys:
-        coins = random.randint(1,100)
+        coins = rng.randint(1,100)
         out.append({"value": coins, "pubkey": pubkey})
     sig = H(str.encode(str(inp) + str(out))).hexdigest()
     number = H(str.encode(str(inp) + str(out) + sig)).hexdigest()
-    transaction = Transaction(number, inp, out, sig)
-    transactionList.append(transaction)
     transactionAsJSON = {'number': number, 'input': inp, 'output': out, 'sig': sig}
     result.append(transactionAsJSON)
 
-def generateTransactions(transactionList, result, 
-                         totalNodes, totalTransactions,
-                         pubkeys, prikeys, pubkeyMap):
+# each transaction is sent by a receiver of the previous transaction, spending (with probability 1/2 each)
+# the earliest outputs paid to it by any transaction but the previous one, and pays random amounts to random nodes
+def generateTransactions(result, totalNodes, totalTransactions, pubkeys, prikeys, pubkeyMap, rng):
+    # pubkey -> (position in result, number, value) of every output paid to it, in the order they were created,
+    # so a sender's outputs are found without scanning every earlier transaction
+    outputsByPubkey = defaultdict(list)
+    for position, transaction in enumerate(result):
+        for out in transaction['output']:
+            outputsByPubkey[out['pubkey']].append((position, transaction['number'], out['value']))
+    # raw signing keys (seed followed by public key), so messages are signed without encoder round trips
+    secretKeys = [bytes(prikey) + bytes(prikey.verify_key) for prikey in prikeys]
     for i in range(1, totalTransactions):
         inputSum = 0
-        transaction = transactionList[len(transactionList)-1]
-        receiver = random.randint(0, len(transaction.out)-1)
-        pubkeyReceiver = transaction.out[receiver]['pubkey']
+        last = len(result)-1
+        transaction = result[last]
+        receiver = rng.randint(0, len(transaction['output'])-1)
+        pubkeyReceiver = transaction['output'][receiver]['pubkey']
         receiverInput, receiverOutput = [], []
-        for receiverTransaction in transactionList:
+        for (position, number, value) in outputsByPubkey[pubkeyReceiver]:
             if (len(receiverInput) == MAX_TRANSACTION_THRESHOLD
-                or inputSum >= MAX_INPUT_LIMIT):
+                or inputSum >= MAX_INPUT_LIMIT
+                or position == last):
                 break
-            elif receiverTransaction == transaction:
-                continue
-            for out in receiverTransaction.out:
-                if (len(receiverInput) == MAX_TRANSACTION_THRESHOLD
-                    or inputSum >= MAX_INPUT_LIMIT):
-                    break
-                if out['pubkey'] == pubkeyReceiver:
-                    choose = choice([True, False])
-                    if choose:
-                        receiverInput.append({"number": receiverTransaction.number, 
-                                              "output": {"value": out['value'], "pubkey": pubkeyReceiver}})
-                        inputSum += out['value']
+            choose = rng.choice([True, False])
+            if choose:
+                receiverInput.append({"number": number, "output": {"value": value, "pubkey": pubkeyReceiver}})
+                inputSum += value
         if not receiverInput:
-            receiverInput.append({"number": transaction.number, 
-                                  "output": {"value": transaction.out[receiver]['value'], "pubkey": pubkeyReceiver}})
-            inputSum += transaction.out[receiver]['value']
-        x = split_money(inputSum, totalNodes)
-        ids = random.sample(range(totalNodes), len(x))
+            receiverInput.append({"number": transaction['number'],
+                                  "output": {"value": transaction['output'][receiver]['value'], "pubkey": pubkeyReceiver}})
+            inputSum += transaction['output'][receiver]['value']
+        x = split_money(inputSum, totalNodes, rng)
+        ids = rng.sample(range(totalNodes), len(x))
         for j in range(len(x)):
             receiverOutput.append({"value": x[j], "pubkey": pubkeys[ids[j]]})
         serializedInput = "".join([str(inp['number']) + str(inp['output']['value']) + str(inp['output']['pubkey'])
                                   for inp in receiverInput])
         serializedOutput = "".join([str(out['value']) + str(out['pubkey']) for out in receiverOutput])
         message = str.encode(serializedInput + serializedOutput)
-        prikey = prikeys[pubkeyMap[pubkeyReceiver]]
-        signed = prikey.sign(message, encoder=nacl.encoding.HexEncoder)
-        sig = str(signed.signature, 'utf-8')
+        secretKey = secretKeys[pubkeyMap[pubkeyReceiver]]
+        signed = nacl.bindings.crypto_sign(message, secretKey)
+        sig = signed[:nacl.bindings.crypto_sign_BYTES].hex()
         number = H(str.encode(serializedInput + serializedOutput + sig)).hexdigest()
-        nextTransaction = Transaction(number, receiverInput, receiverOutput, sig)
-        transactionList.append(nextTransaction)
         transactionAsJSON = {'number': number, 'input': receiverInput, 'output': receiverOutput, 'sig': sig}
         result.append(transactionAsJSON)
+        for out in receiverOutput:
+            outputsByPubkey[out['pubkey']].append((len(result)-1, number, out['value']))
 
-def run(totalCommunities, nodesPerCommunity, transactionLimitPerCommunity):
-    result = []
-    for i in range(totalCommunities):
-        pubkeys, prikeys, pubkeyMap = generateKeys(nodesPerCommunity)
-        transactionList, current = [], []
-        createGenesisTransaction(transactionList, current, pubkeys)
-        generateTransactions(transactionList, current, 
-                             nodesPerCommunity, transactionLimitPerCommunity,
-                             pubkeys, prikeys, pubkeyMap)
-        keys = []
-        for i in range(len(pubkeys)):
-            prikey = prikeys[i].encode(encoder=nacl.encoding.HexEncoder).decode()
-            keys.append([pubkeys[i], prikey])
-        community = {'pool': current, 'signingKeys': keys}
-        result.append(community)
-    return result
+# generates one community from its own seed
+def generateCommunity(nodesPerCommunity, transactionLimitPerCommunity, seed):
+    rng = random.Random(seed)
+    pubkeys, prikeys, pubkeyMap = generateKeys(nodesPerCommunity, rng)
+    current = []
+    createGenesisTransaction(current, pubkeys, rng)
+    generateTransactions(current, nodesPerCommunity, transactionLimitPerCommunity,
+                         pubkeys, prikeys, pubkeyMap, rng)
+    keys = []
+    for i in range(len(pubkeys)):
+        prikey = prikeys[i].encode(encoder=nacl.encoding.HexEncoder).decode()
+        keys.append([pubkeys[i], prikey])
+    return {'pool': current, 'signingKeys': keys}
+
+# seed of the community at index in a run seeded with seed
+def communitySeed(seed, index):
+    return str(seed) + ':' + str(index)
+
+# encodes a community for the output file: an element of the indented JSON array,
+# or JSON Lines (a signing keys line, then one line per transaction)
+def encodeCommunity(community, lines):
+    if lines:
+        encoded = [json.dumps({'signingKeys': community['signingKeys']}, ensure_ascii=False)]
+        encoded += [json.dumps(transaction, ensure_ascii=False) for transaction in community['pool']]
+        return '\n'.join(encoded) + '\n'
+    return json.dumps(community, sort_keys=False, indent=4, ensure_ascii=False).replace('\n', '\n    ')
+
+# process pool entry point: generates and encodes one community
+def _generateEncodedCommunity(args):
+    nodesPerCommunity, transactionLimitPerCommunity, seed, lines = args
+    return encodeCommunity(generateCommunity(nodesPerCommunity, transactionLimitPerCommunity, seed), lines)
 
+# yields the encoded communities of a run in order, generated across workers processes (one per core by default)
+def run(totalCommunities, nodesPerCommunity, transactionLimitPerCommunity, seed=0, lines=False, workers=None):
+    tasks = [(nodesPerCommunity, transactionLimitPerCommunity, communitySeed(seed, i), lines)
+             for i in range(totalCommunities)]
+    workers = min(workers or os.cpu_count() or 1, totalCommunities)
+    if workers <= 1:
+        yield from map(_generateEncodedCommunity, tasks)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(_generateEncodedCommunity, tasks)
+
+# writes encoded communities as they are generated
+# the JSON array is laid out exactly as json.dump(communities, indent=4) would write it
+def writeCommunities(outfile, encodedCommunities, lines):
+    if lines:
+        for encoded in encodedCommunities:
+            outfile.write(encoded)
+        return
+    empty = True
+    for encoded in encodedCommunities:
+        outfile.write(('[' if empty else ',') + '\n    ' + encoded)
+        empty = False
+    outfile.write('[]' if empty else '\n]')
+
+# receives as command-line arguments the number of communities, nodes per community and transactions
+# per community, optionally followed by 'jsonl' to write JSON Lines (a signing keys line per community,
+# then its transactions), 'gz' to gzip the file, and a random seed (a random one is picked and printed if not given)
 def main():
     totalCommunities = int(sys.argv[1])
     nodesPerCommunity = int(sys.argv[2])
     transactionLimitPerCommunity = int(sys.argv[3])
+    options = sys.argv[4:]
+    lines = 'jsonl' in options
+    compress = 'gz' in options
+    seeds = [int(option) for option in options if option not in ('jsonl', 'gz')]
+    seed = seeds[0] if seeds else random.randrange(2**32)
+    filename = ("input/communities_" + str(totalCommunities) + "_nodes_" +
+                str(nodesPerCommunity) + "_transactions_" + str(transactionLimitPerCommunity) +
+                (".jsonl" if lines else ".txt") + (".gz" if compress else ""))
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
     start = time.time()
-    result = run(totalCommunities, nodesPerCommunity, transactionLimitPerCommunity)
+    with (gzip.open(filename, 'wt') if compress else open(filename, 'w')) as outfile:
+        communities = run(totalCommunities, nodesPerCommunity, transactionLimitPerCommunity, seed, lines)
+        writeCommunities(outfile, communities, lines)
     end = time.time()
-    filename = ("input/communities_" + str(totalCommunities) + "_nodes_" + 
-                str(nodesPerCommunity) + "_transactions_" + str(transactionLimitPerCommunity) + ".txt")
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'w') as outfile:
-        json.dump(result, outfile, sort_keys=False, indent=4, ensure_ascii=False)
-        outfile.close()
     print("Transaction file generated (contains double spends): " + filename)
+    print("seed: " + str(seed))
     print("time to generate inputs (sec): " + str(end-start))
-    
+
 if __name__== "__main__":
     main()
@@ -1,22 +1,10 @@
 import sys
-import os
 import time
-import copy
-import json
-import numbers
-from hashlib import sha256 as H
 import random
-from collections import defaultdict
-from threading import Thread
-import time
-import nacl.encoding
-import nacl.signing
-import blockchain
 import utils
-import mergesplit_node
-import mergesplit_community
 import mergesplit_network
 import buildingblocks
+import chainlog
 
 
 # implements main driver function to simulate MergeSplit activity in a network
@@ -39,7 +27,7 @@ class Driver:
         tx = utils.Utils.serializeTransaction(transaction)
         # generate arbitrary prev
         prev = utils.Utils.generateNonce()
-        return buildingblocks.Block(tx, prev, isGenesis=True)
+        return buildingblocks.Block([tx], prev, isGenesis=True)
 
     # reads transactions from input file, creates genesis blow in each node's blockchain,
     # and adds remaining transactions to global, unverified transaction pool
@@ -55,32 +43,59 @@ class Driver:
             # adds genesis to each node's blockchain
             for node in community.nodes:
                 node.chain.setGenesis(genesisBlock)
+                community.metrics.addBlock(node.chain)
             community.updateStake(genesisTransaction)
         self.network.summarize()
         return True
     
     # starts up all threads and runs them
     # simulates network activity
-    def simulate(self):
+    # mode 'process' instead runs communities across worker processes (one per core unless workers is given)
+    # mode 'event' instead runs a deterministic discrete-event simulation reproducible from seed
+    def simulate(self, mode='thread', workers=None, seed=0):
+        if mode == 'event':
+            # seeded before the genesis nonces are drawn so the whole run follows from the seed
+            random.seed(seed)
         self.initializeSimulation()
         print('\ninitialized simulation')
+        # the process and event runners (and multiprocessing/asyncio) are only imported when asked for
+        if mode == 'process':
+            import mergesplit_parallel
+            mergesplit_parallel.simulate(self.network, workers)
+            return
+        if mode == 'event':
+            import mergesplit_events
+            self.simulation = mergesplit_events.simulate(self.network, seed)
+            return
         # start up threads
         for i in range(len(self.network.threads)):
             self.network.threads[i].start()
-        # wait for all threads to finish before exiting
-        for i in range(len(self.network.threads)):
-            self.network.threads[i].join()
+        # wait for all threads to finish before exiting, including those of communities created by splits
+        for thread in self.network.threads:
+            thread.join()
 
 
 # main driver to instantiate MergeSplit driver class and simulate network activity with threads
 # receives as command-line arguments the input file and output directory to store logged blockchains
+# (one chainlog file per community),
+# optionally followed by the execution mode (thread, process or event) and the number of worker processes
+# (process mode) or the random seed (event mode)
 def main():
     # instantiate blockchains main driver
     driver = Driver(sys.argv[1])
-    # run the driver (simulate network activity with threads)
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'thread'
+    option = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    # run the driver (simulate network activity with threads, processes or events)
     start = time.time()
-    driver.simulate()
+    if mode == 'event':
+        driver.simulate(mode, seed=option or 0)
+    else:
+        driver.simulate(mode, option)
     end = time.time()
+    # log each community's blockchains on a background writer while the stats are printed
+    writer = chainlog.Writer(sys.argv[2])
+    for community in driver.network.communities:
+        writer.submit(community)
     
     # log stats after completion
     print(str(len(driver.network.threads)) + " threads spun up")
@@ -91,16 +106,19 @@ def main():
         print("Length of Verified Ledger for community " + str(community.id) + ": " + str(community.checkForMatchedSequences()) )
 
     print('\nElapsed time (sec): ' + str(end-start))
+    if mode == 'event':
+        print('Simulated time (sec): ' + str(driver.simulation.now))
     
     print("Executed: " + str(driver.network.numMerges) + " merges, " + str(driver.network.numSplits) + " splits")
-    # log each node's blockchain to a file
-    root = sys.argv[2]
-    for community in driver.network.communities:
-        filePrefix = root + "/community" + str(community.id)
-        for i in range(len(community.nodes)):
-            filename = filePrefix + "/blockchains_node" + str(i+1) + ".json"
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            community.nodes[i].chain.log(filename)
+    # log the prediction cache (in process mode, the lookups of every worker's cache)
+    predictions = driver.network.predictions
+    print("Prediction cache: " + str(predictions.hits) + " hits, " + str(predictions.misses) + " misses (" +
+          "{:.1%}".format(predictions.hitRate()) + " hit rate)")
+    locks = driver.network.locks
+    print("Merge/split locks: " + str(locks.contended) + " of " + str(locks.attempts) + " attempts contended (" +
+          "{:.1%}".format(locks.contentionRate()) + "), blocks waited " + str(locks.waits) + " times (" +
+          "{:.3f}".format(locks.waitTime) + " sec)")
+    writer.close()
 
 
 if __name__== "__main__":
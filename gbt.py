@@ -0,0 +1,159 @@
+import os
+import json
+import math
+import numpy as np
+import parquetfile
+
+
+# implements inference for a Spark ML PipelineModel of StringIndexer, VectorAssembler and
+# GBTClassificationModel stages, loaded from the directory Spark saved it to without starting Spark
+# the trees are flattened into arrays: batches of examples are scored with NumPy, and single
+# examples (as proposals are scored) walk the same arrays in Python, which is faster for one row
+class GBTPipeline:
+
+    # batches of fewer examples than this are scored in Python, which is faster than NumPy for a few rows
+    smallBatch = 24
+
+    def __init__(self, labels, inputCols, feature, threshold, left, right, value, roots, weights, version=None):
+        # label of each class index (StringIndexer order; the model may have seen fewer labels than classes)
+        self.labels = labels
+        # feature names, in the order the VectorAssembler puts them in the feature vector
+        self.inputCols = inputCols
+        # nodes of every tree: split feature and threshold (go left if feature <= threshold),
+        # child node indices (-1 for leaves) and leaf predictions
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.value = np.asarray(value, dtype=np.float64)
+        # root node index and weight of each tree
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        # the children to step to in batches, where a leaf steps to itself, so every example of a batch
+        # takes depth steps whatever the depth of its leaf
+        leaves = self.left == -1
+        self.stepLeft = np.where(leaves, np.arange(len(self.left)), self.left)
+        self.stepRight = np.where(leaves, np.arange(len(self.right)), self.right)
+        # the same arrays as lists, for single examples
+        self.nodes = list(zip(feature, threshold, left, right, value))
+        self.trees = list(zip(roots, weights))
+        self.depth = self._depth()
+        # identifies the saved model (its uid and save time), so results cached for it are not mistaken for
+        # another model's
+        self.version = version
+
+    # loads a saved PipelineModel directory
+    def load(path):
+        with open(os.path.join(path, 'metadata', 'part-00000')) as f:
+            metadata = json.loads(f.readline())
+        uids = metadata['paramMap']['stageUids']
+        version = (metadata['uid'], metadata['timestamp'])
+        stages = {}
+        for name in os.listdir(os.path.join(path, 'stages')):
+            stages[name.split('_', 1)[1]] = os.path.join(path, 'stages', name)
+        labels, inputCols, model = None, None, None
+        for uid in uids:
+            stage = stages[uid]
+            with open(os.path.join(stage, 'metadata', 'part-00000')) as f:
+                metadata = json.loads(f.readline())
+            kind = metadata['class'].rsplit('.', 1)[1]
+            if kind == 'StringIndexerModel':
+                row = parquetfile.read(os.path.join(stage, 'data'))[0]
+                labels = row['labels'] if 'labels' in row else row['labelsArray'][0]
+            elif kind == 'VectorAssembler':
+                inputCols = metadata['paramMap']['inputCols']
+            elif kind == 'GBTClassificationModel':
+                model = GBTPipeline._loadTrees(stage)
+            else:
+                raise ValueError('Unsupported pipeline stage ' + metadata['class'])
+        if labels is None or inputCols is None or model is None:
+            raise ValueError('Pipeline at ' + path + ' is not a StringIndexer, VectorAssembler and GBT classifier')
+        return GBTPipeline(labels, inputCols, *model, version=version)
+
+    # reads the trees (data) and their weights (treesMetadata) of a GBT stage into flat node arrays
+    def _loadTrees(stage):
+        trees = {}
+        for row in parquetfile.read(os.path.join(stage, 'data')):
+            trees.setdefault(row['treeID'], {})[row['nodeData']['id']] = row['nodeData']
+        weights = {row['treeID']: row['weights'] for row in parquetfile.read(os.path.join(stage, 'treesMetadata'))}
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        for treeID in sorted(trees):
+            nodes = trees[treeID]
+            # node id -> index in the flat arrays
+            index = {id: len(feature) + k for k, id in enumerate(sorted(nodes))}
+            roots.append(index[0])
+            for id in sorted(nodes):
+                node = nodes[id]
+                split = node['split']
+                if node['leftChild'] == -1:
+                    feature.append(0)
+                    threshold.append(0.0)
+                    left.append(-1)
+                    right.append(-1)
+                elif split['numCategories'] != -1:
+                    raise ValueError('Categorical splits are not supported')
+                else:
+                    feature.append(split['featureIndex'])
+                    threshold.append(split['leftCategoriesOrThreshold'][0])
+                    left.append(index[node['leftChild']])
+                    right.append(index[node['rightChild']])
+                value.append(node['prediction'])
+        return feature, threshold, left, right, value, roots, [weights[treeID] for treeID in sorted(trees)]
+
+    # returns the greatest number of splits on a path from a root to a leaf
+    def _depth(self):
+        depth, level = 0, list(self.roots)
+        while True:
+            level = [child for node in level for child in (self.nodes[node][2], self.nodes[node][3]) if child != -1]
+            if not level:
+                return depth
+            depth += 1
+
+    # returns the feature vector of an example given as a dict of feature name -> value
+    def vector(self, features):
+        return [features[name] for name in self.inputCols]
+
+    # returns the summed, weighted tree predictions of one example
+    def margin(self, x):
+        total = 0.0
+        nodes = self.nodes
+        for node, weight in self.trees:
+            feature, threshold, left, right, value = nodes[node]
+            while left != -1:
+                node = left if x[feature] <= threshold else right
+                feature, threshold, left, right, value = nodes[node]
+            total += weight * value
+        return total
+
+    # returns the margins of a batch of examples (one per row)
+    def margins(self, X):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        if len(X) < GBTPipeline.smallBatch:
+            return np.array([self.margin(x) for x in X.tolist()])
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for k in range(self.depth):
+            goLeft = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(goLeft, self.stepLeft[nodes], self.stepRight[nodes])
+        return self.value[nodes] @ self.weights
+
+    # returns the probability of label for one example, as Spark's logistic loss GBT computes it
+    # (class 1 has probability 1 / (1 + exp(-2 margin)))
+    def probability(self, x, label):
+        if label not in self.labels:
+            return 0.0
+        p = 1.0 / (1.0 + math.exp(min(-2.0 * self.margin(x), 700.0)))
+        return p if self.labels.index(label) == 1 else 1.0 - p
+
+    # returns the probability of label for each example of a batch
+    def probabilities(self, X, label):
+        margins = self.margins(X)
+        if label not in self.labels:
+            return np.zeros(len(margins))
+        p = 1.0 / (1.0 + np.exp(np.minimum(-2.0 * margins, 700.0)))
+        return p if self.labels.index(label) == 1 else 1.0 - p
+
+    # returns the predicted label of one example
+    def predict(self, x):
+        index = 1 if self.margin(x) > 0 else 0
+        return self.labels[index] if index < len(self.labels) else None
@@ -0,0 +1,96 @@
+import heapq
+from collections import defaultdict
+
+
+# implements a dependency-ordered pool of pending transactions for a community
+# a transaction waits until every transaction it spends from is on the chain,
+# then moves into a ready queue that keeps the order of the original pool
+# ready transactions are checked against a chain tip; one found invalid is set aside, as it stays invalid
+# on every chain extending that tip (its inputs stay spent, its number stays on the chain), and is
+# readied again once transactions are checked against a tip on another branch, where it may be valid
+class Mempool:
+
+    def __init__(self, pool, chain):
+        self.transactions = list(pool)
+        # heap of pool positions of transactions whose inputs are all on the chain
+        self.ready = []
+        # transaction number -> pool positions of pending transactions spending from it
+        self.waiting = defaultdict(list)
+        # pool position -> transaction numbers a pending transaction still waits on
+        self.missing = {}
+        self.store = chain.store
+        tip = chain.longestChain()
+        # tip transactions were last checked against, and pool positions of those found invalid on its chain
+        self.tip = tip
+        self.rejected = []
+        # transaction number -> pool position of transactions taken for a block not yet confirmed
+        self.taken = {}
+        for position, transaction in enumerate(self.transactions):
+            missing = set([inp.number for inp in transaction.inp
+                           if not chain.containsTransaction(inp.number, tip)])
+            if missing:
+                self.missing[position] = missing
+                for number in missing:
+                    self.waiting[number].append(position)
+            else:
+                heapq.heappush(self.ready, position)
+
+    # moves the check to tip, readying the set-aside transactions again unless tip extends the chain
+    # they were found invalid on
+    def _checkAt(self, tip):
+        if tip is not self.tip and not self.store.isAncestor(self.tip, tip):
+            for position in self.rejected:
+                heapq.heappush(self.ready, position)
+            self.rejected = []
+        self.tip = tip
+
+    # returns the first ready transaction accepted by isValid at tip, leaving it at the head of the queue
+    # transactions isValid rejects are set aside until a tip on another branch is checked
+    def nextReady(self, tip, isValid):
+        self._checkAt(tip)
+        while self.ready:
+            transaction = self.transactions[self.ready[0]]
+            if isValid(transaction):
+                return transaction
+            self.rejected.append(heapq.heappop(self.ready))
+        return None
+
+    # removes and returns up to size ready transactions, in pool order, that can share a block at tip
+    # invalid transactions are set aside as in nextReady; valid ones that canJoin rejects stay queued
+    # for a later block
+    def take(self, size, tip, isValid, canJoin):
+        self._checkAt(tip)
+        batch, deferred = [], []
+        while self.ready and len(batch) < size:
+            position = heapq.heappop(self.ready)
+            transaction = self.transactions[position]
+            if not isValid(transaction):
+                self.rejected.append(position)
+                continue
+            if canJoin(batch, transaction):
+                batch.append(transaction)
+                self.taken[transaction.number] = position
+            else:
+                deferred.append(position)
+        for position in deferred:
+            heapq.heappush(self.ready, position)
+        return batch
+
+    # puts transactions taken for a block that was not accepted back in the ready queue
+    def restore(self, transactions):
+        for transaction in transactions:
+            heapq.heappush(self.ready, self.taken.pop(transaction.number))
+
+    # records that a transaction number is now on the chain, readying transactions waiting on it
+    def confirm(self, number):
+        self.taken.pop(number, None)
+        for position in self.waiting.pop(number, []):
+            missing = self.missing[position]
+            missing.discard(number)
+            if not missing:
+                del self.missing[position]
+                heapq.heappush(self.ready, position)
+
+    # number of transactions still pending (ready, waiting, set aside or taken for an unconfirmed block)
+    def __len__(self):
+        return len(self.ready) + len(self.missing) + len(self.rejected) + len(self.taken)
@@ -1,25 +1,27 @@
-import sys
-import os
-import copy
-import json
 import numpy as np
-import numbers
 from hashlib import sha256 as H
 import random
 from collections import defaultdict
-from threading import Thread
-import time
 import nacl.encoding
-import nacl.signing
 import blockchain
 import utils
 import mergesplit_node
 import mergesplit_network
 import buildingblocks
+import mempool
 
 
 # implements an individual network/subgroup of nodes/transaction pools
 class Community:
+
+    # if set, every node fully re-verifies each broadcast block instead of reusing
+    # the verdict of the first node that validated it against the same prev
+    paranoid = False
+    # maximum number of pool transactions packed into one block
+    blockSize = 1
+    # if set, agreement between the community's nodes is sampled every sampleInterval steps
+    # into divergenceSamples as (step, longest chain height, first divergence height or None)
+    sampleInterval = 0
     
     def __init__(self, network, id, pool, keys=None, nodeList=None):
         # store parent network this community is a part of
@@ -32,22 +34,33 @@ class Community:
         self.nodeLookup = {}
         # community's unique transaction pool
         self.pool = pool
+        # dependency-ordered view of the pool, built when the community starts running
+        self.mempool = None
         # community's unique id
         self.id = id
+        # steps run so far, and the agreement samples taken (see sampleInterval)
+        self.steps = 0
+        self.divergenceSamples = []
         if nodeList:
+            # blocks shared by every node in the community
+            self.store = nodeList[0].chain.store
             self.nodeCount = len(nodeList)
             self.nodes = nodeList
             for i in range(self.nodeCount):
-                self.nodeLookup[self.nodes[i].getPublicKey] = self.nodes[i]
+                self.nodeLookup[self.nodes[i].publicKey] = self.nodes[i]
+                self.nodes[i].community = self
         else:
+            self.store = blockchain.BlockStore()
             # create constituent nodes of community
             self.nodeCount = len(keys)
             for i in range(self.nodeCount):
                 node = mergesplit_node.Node(keys[i][0], keys[i][1], self)
                 self.nodes.append(node)
                 self.nodeLookup[keys[i][0]] = node
-        # if locked, that means someone is currently merging/splitting it
-        self.isLocked = False
+        # stake-weighted sampler over the nodes, kept up to date as stakes change
+        self.stakes = buildingblocks.StakeSampler(self.nodes)
+        # the community's features for the mergesplit models, kept up to date as it changes
+        self.metrics = buildingblocks.CommunityMetrics(self.nodes)
         
     def getCommunityNodes(self):
         return self.nodes
@@ -66,10 +79,10 @@ class Community:
     def fetchUpToDateBlockchain(self):
         if self.nodeCount > 0:
             chain = self.nodes[0].chain
-            # return deep copy of a node's blockchain
-            return copy.deepcopy(chain)
+            # return a copy of a node's view, sharing the community's block store
+            return chain.copy()
         else:
-            return blockchain.BlockChain()
+            return blockchain.BlockChain(self.store)
 
     # dynamically add forgers to the community
     def add(self, publicKey, privateKey):
@@ -79,34 +92,42 @@ class Community:
         self.nodeLookup[publicKey] = node
         # update node count
         self.nodeCount += 1
+        self.stakes.add(node)
         node.chain = self.fetchUpToDateBlockchain()
+        self.metrics.addNode(node)
 
     def selectCreator(self):
-        # randomly sample validators from nodeCount according to stake
-        dist = [0] * self.nodeCount
-        totalStake = sum([node.stake for node in self.nodes])
-        if totalStake == 0:
-            dist = [1./len(self.nodes) for node in self.nodes]
-        else:
-            dist = [node.stake / totalStake for node in self.nodes]
-        # randomly samply validator for proof of stake
-        creator = np.random.choice(self.nodeCount, 1, p=dist)[0]
-        return self.nodes[creator]
+        # randomly sample a validator for proof of stake, uniformly while no node has stake
+        u = np.random.random_sample()
+        if self.stakes.total == 0:
+            return self.nodes[int(u * self.nodeCount)]
+        return self.stakes.sample(u)
 
     # updates stake for a node in the community
     def updateStake(self, transaction):
         stakes = defaultdict(int)
         for inp in transaction.inp:
-            if inp['output']['pubkey'] in self.nodeLookup:
-                stakes[inp['output']['pubkey']] -= inp['output']['value']
+            if inp.pubkey in self.nodeLookup:
+                stakes[inp.pubkey] -= inp.value
         for out in transaction.out:
-            if out['pubkey'] in self.nodeLookup:
-                stakes[out['pubkey']] += out['value']
+            if out.pubkey in self.nodeLookup:
+                stakes[out.pubkey] += out.value
         for node in stakes:
             self.nodeLookup[node].stake += stakes[node]
+            self.stakes.update(self.nodeLookup[node], stakes[node])
+            self.metrics.updateStake(stakes[node])
 
     # check if a transaction exists in pool that could be added to longest chain
+    # (of any node: nodes usually share one, so each distinct longest chain is checked once)
     def validTransactionExists(self):
+        if self.mempool is not None:
+            tips = {}
+            for node in self.nodes:
+                tips.setdefault(node.chain.longestChain(), node)
+            for (tip, node) in tips.items():
+                if self.mempool.nextReady(tip, lambda t: node.validate(t, tip)) is not None:
+                    return True
+            return False
         for node in self.nodes:
             if node.validTransactionExists():
                 return True
@@ -127,31 +148,103 @@ class Community:
 
     # driver run function executed within thread context
     def run(self):
+        self.start()
         # as long as valid transactions exist in the community
-        while self.validTransactionExists():
-            # randomly sample a validator to propose a block
-            creator = self.selectCreator()
-            # check if the selected node chooses to propose a merge/split
-            self.checkProposal(creator)
-            for transaction in self.pool:
-                # select a transaction to include in the proposed block
-                tx = utils.Utils.serializeTransaction(transaction)
-                # validate the transaction
-                if creator.validate(transaction, creator.chain.longestChain()):
-                    chain = self.nodes[0].chain
-                    prev = H(str.encode(utils.Utils.serializeBlock(chain.longestChain().block))).hexdigest()
-                    block = buildingblocks.Block(tx, prev)
-                    # broadcast block to be added to the blockchain
-                    self.broadcast(block)
-                    break
+        while self.step():
+            pass
+
+    # prepares the community's mempool before its first step
+    def start(self):
+        self.mempool = mempool.Mempool(self.pool, self.nodes[0].chain)
+
+    # one iteration of the run loop: a creator is sampled, may propose a merge/split,
+    # then forges and broadcasts a block
+    # returns False once no valid transaction is left in the community
+    # the event simulation runs the same phases (beginStep, forgeStep, endStep), waiting between them
+    def step(self):
+        creator = self.beginStep()
+        if creator is None:
+            return False
+        self.endStep(self.forgeStep(creator))
+        return True
+
+    # first phase of a step: returns the validator sampled to propose a block,
+    # or None once no valid transaction is left in the community
+    def beginStep(self):
+        if not self.validTransactionExists():
+            return None
+        # randomly sample a validator for proof of stake
+        return self.selectCreator()
+
+    # second phase of a step: the creator may propose a merge/split, then forges its block
+    # holding the community's lock, so no merge/split runs on the community until endStep
+    # returns None if the proposal split the creator off into another community (no lock is taken), and
+    # otherwise the block and its transactions, or () if no transaction can be added
+    def forgeStep(self, creator):
+        # check if the selected node chooses to propose a merge/split
+        self.checkProposal(creator)
+        if creator.community is not self:
+            return None
+        locks = self.network.locks if self.network else None
+        if locks:
+            locks.acquire(self.id)
+        try:
+            return self.forge(creator) or ()
+        except BaseException:
+            if locks:
+                locks.release([self.id])
+            raise
+
+    # last phase of a step: broadcasts the forged block, releases the community's lock and counts the step,
+    # sampling agreement every sampleInterval steps
+    def endStep(self, proposed):
+        try:
+            if proposed:
+                self.commit(*proposed)
+        finally:
+            if proposed is not None and self.network:
+                self.network.locks.release([self.id])
+        self.steps += 1
+        if Community.sampleInterval and self.steps % Community.sampleInterval == 0:
+            self.sampleDivergence()
+
+    # records whether the community's nodes currently agree on their longest chain
+    def sampleDivergence(self):
+        height = max(node.chain.longestChain().height for node in self.nodes)
+        self.divergenceSamples.append((self.steps, height, self.firstDivergence()))
+
+    # builds the creator's next block from the mempool
+    # returns the block and its transactions, or None if no transaction can be added
+    def forge(self, creator):
+        # select the first ready transactions the creator finds valid and non-conflicting
+        tip = creator.chain.longestChain()
+        transactions = self.mempool.take(Community.blockSize, tip,
+                                         lambda t: creator.validate(t, tip),
+                                         lambda batch, t: creator.canJoinBatch(batch, t, tip))
+        if not transactions:
+            return None
+        txs = [utils.Utils.serializeTransaction(transaction) for transaction in transactions]
+        chain = self.nodes[0].chain
+        prev = chain.longestChain().block.getHash()
+        block = buildingblocks.Block(txs, prev)
+        block.setTransactions(transactions)
+        return block, transactions
+
+    # broadcasts a forged block and, if accepted, releases transactions waiting on it
+    # (if not, its transactions stay in the mempool for a later block)
+    def commit(self, block, transactions):
+        if self.broadcast(block):
+            for transaction in transactions:
+                self.mempool.confirm(transaction.number)
+        else:
+            self.mempool.restore(transactions)
 
     # construct mergesplit transaction fee (novel incentive scheme)
     def accrueTransactionFee(self, receiver):
-        receiverInp = []
-        receiverOut = [{"value": mergesplit_network.Network.mergesplitFee, "pubkey": receiver.publicKey}]
-        serializedInput = "".join([str(inp['number']) + str(inp['output']['value']) + str(inp['output']['pubkey'])
-                                  for inp in receiverInp])
-        serializedOutput = "".join([str(out['value']) + str(out['pubkey']) for out in receiverOut])
+        receiverInp = ()
+        receiverOut = (buildingblocks.Output(mergesplit_network.Network.mergesplitFee, receiver.publicKey),)
+        serializedInput = "".join([str(inp.number) + str(inp.value) + str(inp.pubkey) for inp in receiverInp])
+        serializedOutput = "".join([str(out.value) + str(out.pubkey) for out in receiverOut])
         # message to sign for mergesplit fee
         message = str.encode(serializedInput + serializedOutput)
         # sign the message
@@ -162,38 +255,52 @@ class Community:
         transaction = buildingblocks.Transaction(number, receiverInp, receiverOut, sig)
         tx = utils.Utils.serializeTransaction(transaction)
         chain = self.nodes[0].chain
-        prev = H(str.encode(utils.Utils.serializeBlock(chain.longestChain().block))).hexdigest()
-        block = buildingblocks.Block(tx, prev, False, True)
+        prev = chain.longestChain().block.getHash()
+        block = buildingblocks.Block([tx], prev, False, True)
         # add mergesplit fee block to every node's chain
         for node in self.nodes:
             node.chain.addBlock(block)
+            self.metrics.addBlock(node.chain)
         # update stake of receiver of the fee
         receiver.stake += mergesplit_network.Network.mergesplitFee
+        self.stakes.update(receiver, mergesplit_network.Network.mergesplitFee)
+        self.metrics.updateStake(mergesplit_network.Network.mergesplitFee)
         return True
 
     # broadcasts a proposed block to all nodes to verify and add to their blockchains
     def broadcast(self, block):
-        # each node verifies the block
+        # each node verifies the block, sharing one validation unless paranoid
+        verdicts = None if Community.paranoid else {}
         for node in self.nodes:
-            if not node.verifyProposal(block):
+            if not node.verifyProposal(block, verdicts):
                 return False
         # if verification passed, nodes add the block to their blockchain
         for node in self.nodes:
             # restart indicates that each node should stop their pow calculation
             node.chain.addBlock(block)
-        # update stakes of forgers after processing transaction
-        self.updateStake(utils.Utils.deserializeTransaction(block.tx))
+            self.metrics.addBlock(node.chain)
+        # update stakes of forgers after processing transactions
+        for transaction in block.getTransactions():
+            self.updateStake(transaction)
         return True
 
-    def merge(self, neighbor):
-        # Query all nodes in both community to see if they want to merge
+    # answers a merge request from another community
+    # returns whether 2/3 of this community's nodes approve and, if so,
+    # the unspent outputs and tip hash of this community's longest chain needed for the merge block
+    def mergeSnapshot(self):
         approved = 0
-        neighborNodes = neighbor.getCommunityNodes()
-        for node in neighborNodes:
+        for node in self.nodes:
             if node.approveMerge():
                 approved +=  1
-                
-        if approved < (neighbor.nodeCount*2/3):
+        if approved < (self.nodeCount*2/3):
+            return False, None, None
+        block_node = self.fetchUpToDateBlockchain().longestChain()
+        return True, self.getValidOutputs(block_node), block_node.block.getHash()
+
+    def merge(self, neighbor):
+        # Query all nodes in both community to see if they want to merge
+        approved, neighborOutputs, prevNeighbor = neighbor.mergeSnapshot()
+        if not approved:
             return False, None
 
         approved = 0
@@ -203,15 +310,15 @@ class Community:
         if approved < (self.nodeCount*2/3):
             return False,None
 
-        transaction = self.generateMergeTransaction(neighbor)
+        transaction = self.generateMergeTransaction(neighborOutputs)
         transaction = utils.Utils.serializeTransaction(transaction)
         
         # add a new merge block to remaining nodes blockchain
-        serialSelf = utils.Utils.serializeBlock(self.fetchUpToDateBlockchain().longestChain().block)
-        serialNeighbor = utils.Utils.serializeBlock(neighbor.fetchUpToDateBlockchain().longestChain().block)
-        mergeBlock = buildingblocks.Block(transaction, H(str.encode(serialSelf)).hexdigest(), isMerge=True, mergePrev2 =  H(str.encode(serialNeighbor)).hexdigest())
+        prevSelf = self.fetchUpToDateBlockchain().longestChain().block.getHash()
+        mergeBlock = buildingblocks.Block([transaction], prevSelf, isMerge=True, mergePrev2=prevNeighbor)
         for node in self.nodes:
             node.chain.addBlock(mergeBlock)
+            self.metrics.addBlock(node.chain)
         '''
         for node in neighbor.nodes:
             node.chain.addBlock(mergeBlock)
@@ -250,10 +357,15 @@ class Community:
             self.pool.append(tx)
         return True, self'''
     
+    # splits half the nodes off into a new community
+    # the remaining half stays this community, keeping its id, lock, mempool and the thread or task running it;
+    # returns the status of the split, this community and the new one
     def split(self):
         # randomly select half the nodes to split
         newCommunityNodes = []
         np.random.shuffle(self.nodes)
+        # the sampler follows the order of the nodes
+        self.stakes = buildingblocks.StakeSampler(self.nodes)
         for i in range(int(self.nodeCount/2)):
             newCommunityNodes.append(self.nodes[i])
         
@@ -269,48 +381,68 @@ class Community:
         for newNode in newCommunityNodes:
             pubkeys.append(newNode.publicKey)
             self.nodes.remove(newNode)
+            del self.nodeLookup[newNode.publicKey]
+        self.nodeCount = len(self.nodes)
+        self.stakes = buildingblocks.StakeSampler(self.nodes)
+        self.metrics.refresh(self.nodes)
 
         transaction, newTransaction = self.generateSplitTransactions(pubkeys)
         transaction = utils.Utils.serializeTransaction(transaction)
         newTransaction = utils.Utils.serializeTransaction(newTransaction)
 
         # add a new split block to remaining nodes blockchain
-        serial = utils.Utils.serializeBlock(self.fetchUpToDateBlockchain().longestChain().block)
-        splitBlock = buildingblocks.Block(transaction, H(str.encode(serial)).hexdigest(), isSplit=True)
+        prev = self.fetchUpToDateBlockchain().longestChain().block.getHash()
+        splitBlock = buildingblocks.Block([transaction], prev, isSplit=True)
         for node in self.nodes:
             node.chain.addBlock(splitBlock)
+            self.metrics.addBlock(node.chain)
 
         # create a new blockchain for all nodes that are in the new community
-        newBlock = buildingblocks.Block(newTransaction, None)
+        newBlock = buildingblocks.Block([newTransaction], None)
+        newStore = blockchain.BlockStore()
         for node in newCommunityNodes:
-            newBlockChain = blockchain.BlockChain()
+            newBlockChain = blockchain.BlockChain(newStore)
             newBlockChain.setGenesis(newBlock)
             node.setBlockChain(newBlockChain)
 
-        community1 = Community(self.network, random.randint(0,10**10), pool=self.pool, 
-                               keys=None, nodeList=self.nodes)
-        community2 = Community(self.network, random.randint(0,10**10), pool=self.pool, 
-                               keys=None, nodeList=newCommunityNodes)
-        return True, community1, community2
+        community = Community(self.network, random.randint(0,10**10), pool=self.pool, 
+                              keys=None, nodeList=newCommunityNodes)
+        return True, self, community
 
     # quick check to find length of longest chain in each node's blockchain in a community
     # returns the length of this longest chain if all nodes share the same longest chain
     # returns False if there are 2 forked chains in a community with same longest length (can just rerun)
+    # chains are compared by the height and digest of their tips, without walking them
     def checkForMatchedSequences(self):
-        for i in range(0, len(self.nodes)-1):
-            current = self.nodes[i].chain.longestChain()
-            nxt = self.nodes[i+1].chain.longestChain()
-            size = 0
-            while current:
-                if (current.block.tx != nxt.block.tx
-                        or current.block.prev != nxt.block.prev):
-                    return False
-                current = current.prev
-                nxt = nxt.prev
-                size += 1
-            if nxt:
-                return False
-        return size
+        digests = set(node.chain.longestDigest() for node in self.nodes)
+        if len(digests) != 1:
+            return False
+        return digests.pop()[0]
+
+    # returns the lowest height at which some node's longest chain differs from the first node's,
+    # or None if all nodes share the same longest chain
+    def firstDivergence(self):
+        if self.checkForMatchedSequences() is not False:
+            return None
+        first = self.nodes[0].chain.longestChain()
+        divergence = None
+        for node in self.nodes[1:]:
+            tip = node.chain.longestChain()
+            if tip.height == first.height and tip.digest == first.digest:
+                continue
+            height = self.store.forkHeight(first, tip) + 1
+            if divergence is None or height < divergence:
+                divergence = height
+        return divergence
+
+    # helper function to sign and number a split/merge transaction from its inputs and outputs
+    # (hashing their JSON form)
+    def writeTransaction(self, inp, out):
+        inp, out = tuple(inp), tuple(out)
+        serialized = str(utils.Utils.inputsToJson(inp)) + str(utils.Utils.outputsToJson(out))
+        sig = H(str.encode(serialized)).hexdigest()
+        number = H(str.encode(serialized + sig)).hexdigest()
+        return buildingblocks.Transaction(number, inp, out, sig)
 
     # helper function to write the genesis transaction
     # new_chain_balances: pubkey -> balance dict
@@ -322,12 +454,10 @@ class Community:
         # create a new output genesis transaction with the balances owned by each pubkey as output
         for key in new_chain_balances.keys():
             coins = new_chain_balances[key]
-            out.append({"value": coins, "pubkey": key})
+            out.append(buildingblocks.Output(coins, key))
             total += coins
 
-        sig = H(str.encode(str(inp) + str(out))).hexdigest()
-        number = H(str.encode(str(inp) + str(out) + sig)).hexdigest()
-        transaction = buildingblocks.Transaction(number, inp, out, sig)
+        transaction = self.writeTransaction(inp, out)
 
         return transaction, total
 
@@ -339,25 +469,24 @@ class Community:
         out = []
         input_val = 0
         output_val = 0
-        output_pairs = [item for item in old_chain_retain if item not in old_chain_to_zero]
+        zeroed = set(old_chain_to_zero)
+        output_pairs = [item for item in old_chain_retain if item not in zeroed]
 
         # set put all viable outputs to the input of this new transaction
         for (number, value, pubkey) in old_chain_retain:
-            inp.append({"number": number, "output": {"value": value, "pubkey": pubkey}})
+            inp.append(buildingblocks.Input(number, value, pubkey))
             input_val += value
 
         # set all inputs not remaining in the old chain to output to 0
         for (number, value, pubkey) in old_chain_to_zero:
-            out.append({"value": 0, "pubkey": pubkey})
+            out.append(buildingblocks.Output(0, pubkey))
 
         # set all inputs remaining in the old chain to output to their original output value
         for (number, value, pubkey) in output_pairs:
-            out.append({"value": value, "pubkey": pubkey})
+            out.append(buildingblocks.Output(value, pubkey))
             output_val += value
 
-        sig = H(str.encode(str(inp) + str(out))).hexdigest()
-        number = H(str.encode(str(inp) + str(out) + sig)).hexdigest()
-        transaction = buildingblocks.Transaction(number, inp, out, sig)
+        transaction = self.writeTransaction(inp, out)
 
         if input_val > output_val:
             return transaction, input_val - output_val
@@ -369,62 +498,18 @@ class Community:
     # pubkeys = list of public keys in the new community (split community)
     def generateSplitTransactions(self, pubkeys):
         block_node = self.fetchUpToDateBlockchain().longestChain()
-        new_chain_balances = defaultdict(int)  # {pubkey: balance} dict for new genesis block
-        old_chain_to_zero = []  # list of (number, pubkey, value) pairs that are added to new genesis block
-        old_chain_spent = []  # helper list for transactions that are spent (inputs in a block on chain)
-        old_chain_retain = []  # list of (number, pubkey, value) pairs that are still valid to be used as inputs
-
-        while True:
-            block = block_node.block
-            tx = utils.Utils.deserializeTransaction(block.tx)
-            out = tx.out
-            inp = tx.inp
-
-            # iterate through all inputs and remove them as viable balances
-            for item in inp:
-                number = item["number"]
-                pubkey = item["output"]["pubkey"]
-                value = item["output"]["value"]
-                transaction = (number, value, pubkey)
-
-                # add transaction to spent transactions list of old chain
-                old_chain_spent.append(transaction)
-
-                # remove already spent transaction from initial balance of new chain
-                # should be no overflow error since using python
-                if pubkey in pubkeys:
-                    new_chain_balances[pubkey] -= value
-
-            # iterate through all outputs and add them as viable balances
-            for item in out:
-                number = tx.number
-                pubkey = item["pubkey"]
-                value = item["value"]
-                transaction = (number, value, pubkey)
-
-                # check if transaction has been spent, if not add to retained transactions
-                if transaction in old_chain_spent:
-                    old_chain_spent.remove(transaction)
-                else:
-                    old_chain_retain.append(transaction)
-                    # if transaction will be added to new community, add to list of transactions that will be zeroed
-                    if pubkey in pubkeys:
-                        old_chain_to_zero.append(transaction)
-
-                # add output transaction to initial balance of new chain
-                if pubkey in pubkeys:
-                    new_chain_balances[pubkey] += value
-
-            # check if current block is a genesis block, split block or merge block, if so all transactions prior should
-            # be accounted for so stop
-            if not block.isGenesis and not block.isSplit and not block.isMerge:
-                block_node = block_node.prev
-                continue
-            else:
-                break
+        # outputs and balances since the last genesis, split or merge block, kept up to date by the block store
+        segment = self.store.segmentAt(block_node)
+        pubkeys = set(pubkeys)
+        # {pubkey: balance} dict for new genesis block
+        new_chain_balances = {pubkey: balance for pubkey, balance in segment.balances.items() if pubkey in pubkeys}
+        # list of (number, value, pubkey) outputs that are still valid to be used as inputs
+        old_chain_retain = segment.unspent()
+        # those of them that are added to new genesis block
+        old_chain_to_zero = [transaction for transaction in old_chain_retain if transaction[2] in pubkeys]
 
         # final check to see if any spent(input) transactions remain suggesting a double spend
-        if len(old_chain_spent) == 0:
+        if segment.unmatched == 0:
             split_tx, sent_to_gen = self.writeSplitTransaction(old_chain_to_zero, old_chain_retain)
             gen, total = self.writeGenesisSplitTransaction(new_chain_balances)
             if sent_to_gen == total:
@@ -445,22 +530,19 @@ class Community:
         
         # set put all viable outputs to the input & output of this new transaction
         for (number, value, pubkey) in chain_one:
-            inp.append({"number": number, "output": {"value": value, "pubkey": pubkey}})
+            inp.append(buildingblocks.Input(number, value, pubkey))
             input_val += value
-            out.append({"value": value, "pubkey": pubkey})
+            out.append(buildingblocks.Output(value, pubkey))
             output_val += value
         
         # set put all viable outputs to the input & output of this new transaction
         for (number, value, pubkey) in chain_two:
-            inp.append({"number": number, "output": {"value": value, "pubkey": pubkey}})
+            inp.append(buildingblocks.Input(number, value, pubkey))
             input_val += value
-            out.append({"value": value, "pubkey": pubkey})
+            out.append(buildingblocks.Output(value, pubkey))
             output_val += value
 
-
-        sig = H(str.encode(str(inp) + str(out))).hexdigest()
-        number = H(str.encode(str(inp) + str(out) + sig)).hexdigest()
-        transaction = buildingblocks.Transaction(number, inp, out, sig)
+        transaction = self.writeTransaction(inp, out)
 
         if input_val == output_val:
             return transaction
@@ -468,56 +550,16 @@ class Community:
             print("ERROR TRANSACTION INPUT NOT EQUAL TO OUTPUT")
 
     # generates a transaction with two previous hashes to the last block of the communities being merged
-    def generateMergeTransaction(self, neighbor):
+    # neighbor_chain_retain: unspent outputs of the neighbor's chain, from its mergeSnapshot
+    def generateMergeTransaction(self, neighbor_chain_retain):
         block_node = self.fetchUpToDateBlockchain().longestChain()
         this_chain_retain = self.getValidOutputs(block_node)
-        block_node = neighbor.fetchUpToDateBlockchain().longestChain()
-        neighbor_chain_retain = self.getValidOutputs(block_node)
 
         tx = self.writeMergeTransaction(this_chain_retain, neighbor_chain_retain)
 
         return tx
 
-    # returns the valid outputs (unspent outputs) in the block chain starting from block_node
+    # returns the valid outputs (unspent outputs) in the block chain starting from block_node,
+    # back to the last genesis, split or merge block, as (number, value, pubkey) tuples
     def getValidOutputs(self, block_node):
-        this_chain_spent = []  # helper list for transactions that are spent (inputs in a block on chain)
-        this_chain_retain = []  # list of (number, pubkey, value) pairs that are still valid to be used as inputs
-
-        while True:
-            block = block_node.block
-            tx = utils.Utils.deserializeTransaction(block.tx)
-            out = tx.out
-            inp = tx.inp
-
-            # iterate through all inputs and remove them as viable balances
-            for item in inp:
-                number = item["number"]
-                pubkey = item["output"]["pubkey"]
-                value = item["output"]["value"]
-                transaction = (number, value, pubkey)
-
-                # add transaction to spent transactions list of old chain
-                this_chain_spent.append(transaction)
-
-            # iterate through all outputs and add them as viable balances
-            for item in out:
-                number = tx.number
-                pubkey = item["pubkey"]
-                value = item["value"]
-                transaction = (number, value, pubkey)
-
-                # check if transaction has been spent, if not add to retained transactions
-                if transaction in this_chain_spent:
-                    this_chain_spent.remove(transaction)
-                else:
-                    this_chain_retain.append(transaction)
-
-            # check if current block is a genesis block, split block or merge block, if so all transactions prior should
-            # be accounted for so stop
-            if not block.isGenesis and not block.isSplit and not block.isMerge:
-                block_node = block_node.prev
-                continue
-            else:
-                break
-
-        return this_chain_retain
+        return self.store.segmentAt(block_node).unspent()
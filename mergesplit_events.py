@@ -0,0 +1,134 @@
+import sys
+import random
+import traceback
+import heapq
+import itertools
+import asyncio
+from collections import defaultdict
+import numpy as np
+
+
+# implements a deterministic discrete-event simulation of a network on a simulated clock
+# every community is an asyncio task; instead of running freely on threads, a task only
+# advances when the clock reaches the next event it scheduled, one task at a time, so a
+# run is fully reproducible from its seed
+class Simulation:
+
+    # mean simulated seconds between a community's blocks
+    blockInterval = 1.0
+    # mean simulated seconds a creator takes to decide on a merge/split proposal
+    proposalDelay = 0.1
+    # mean simulated seconds for a forged block to reach the community's nodes
+    broadcastDelay = 0.2
+
+    def __init__(self, network, seed=0):
+        self.network = network
+        # seeds the protocol's own random choices; event delays use a separate stream
+        # so changing the delays does not change the protocol's decisions
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        self.random = random.Random(seed)
+        # simulated time in seconds
+        self.now = 0.0
+        # heap of (time, sequence, future, kind, task) wakeups; the sequence breaks ties in scheduling order
+        self.events = []
+        self.sequence = itertools.count()
+        # community id -> task running it
+        self.tasks = {}
+        # task currently allowed to run, and a future it resolves when it waits again
+        self.current = None
+        self.parked = None
+        # number of processed events of each kind
+        self.counts = defaultdict(int)
+        self.loop = None
+
+    # waits delay simulated seconds (exponentially distributed around mean if given)
+    async def sleep(self, delay=None, mean=None, kind=None):
+        if mean is not None:
+            delay = self.random.expovariate(1.0 / mean)
+        wake = self.loop.create_future()
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), wake, kind, asyncio.current_task()))
+        self._park()
+        await wake
+
+    # hands control back to the scheduler
+    def _park(self):
+        if asyncio.current_task() is self.current and not self.parked.done():
+            self.parked.set_result(None)
+
+    # starts running a community added to the network
+    def spawn(self, community):
+        task = self.loop.create_task(self._run(community))
+        self.tasks[community.id] = task
+
+    # stops running a community removed from the network (merged away or split)
+    # a community retiring itself stops at its next event
+    def retire(self, id):
+        task = self.tasks.pop(id, None)
+        if task:
+            task.cancel()
+
+    # a community's run loop, with the merge/split proposal, block production and broadcast as events
+    async def _run(self, community):
+        try:
+            # start at a random offset so communities do not all move in lockstep
+            await self.sleep(mean=Simulation.blockInterval, kind='start')
+            community.start()
+            # the phases of Community.step, with the proposal and broadcast delays between them
+            creator = community.beginStep()
+            while creator is not None:
+                await self.sleep(mean=Simulation.proposalDelay, kind='proposal')
+                proposed = community.forgeStep(creator)
+                # the community's lock is held from forgeStep to endStep, so no merge/split proposed by
+                # another community while the block is broadcast runs on it (nor is it merged away and retired)
+                if proposed:
+                    await self.sleep(mean=Simulation.broadcastDelay, kind='broadcast')
+                community.endStep(proposed)
+                await self.sleep(mean=Simulation.blockInterval, kind='block')
+                creator = community.beginStep()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # report a failed community like a failed thread would, and let the others carry on
+            print('Exception in community ' + str(community.id) + ':', file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            if self.tasks.get(community.id) is asyncio.current_task():
+                del self.tasks[community.id]
+            self._park()
+
+    # processes events in time order until no community has anything left to do
+    async def _schedule(self):
+        for community in list(self.network.communities):
+            self.spawn(community)
+        # let every task run up to its first event
+        await asyncio.sleep(0)
+        while self.events:
+            time, sequence, wake, kind, task = heapq.heappop(self.events)
+            if wake.done():
+                # the waiting task was cancelled
+                continue
+            self.now = time
+            self.counts[kind] += 1
+            self.current = task
+            self.parked = self.loop.create_future()
+            wake.set_result(None)
+            await self.parked
+
+    # runs the simulation to completion and returns the simulated time elapsed
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.network.simulation = self
+        try:
+            self.loop.run_until_complete(self._schedule())
+        finally:
+            self.network.simulation = None
+            self.loop.close()
+        return self.now
+
+
+# runs the network's communities as a discrete-event simulation reproducible from seed
+def simulate(network, seed=0):
+    simulation = Simulation(network, seed)
+    simulation.run()
+    return simulation
@@ -1,43 +1,40 @@
-import sys
 import os
-import copy
-import json
-import numbers
-from hashlib import sha256 as H
 import random
-from collections import defaultdict
-from threading import Thread
 import time
-import nacl.encoding
-import nacl.signing
-import blockchain
+from threading import Thread, Lock, current_thread
+import numpy as np
 import utils
-import mergesplit_node
-import mergesplit_community
-import buildingblocks
-from pyspark import SparkContext
-from pyspark.ml import Pipeline, PipelineModel
-from pyspark.ml.classification import GBTClassifier
-from pyspark.ml.feature import StringIndexer
-from pyspark.ml.feature import * 
-from pyspark.sql import SQLContext, SparkSession, Row
-from pyspark.sql.types import *
-import pyspark.sql.functions as F
+import gbt
 
 
 # implements a parent network that holds constituent disjoint communities
 class Network:
 
-    # set Spark context
-    spark = SparkSession.builder.appName('mergesplit').getOrCreate()
     # model file for mergesplit merge model
-    mergeModelPath = "./models/spark-merge-model"
+    mergeModelPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "spark-merge-model")
     # model file for mergesplit split model
-    splitModelPath = "./models/spark-split-model"
+    splitModelPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "spark-split-model")
     # prediction threshold for mergesplit models to recommend an action
     predictionThreshold = 0.6
+    # label the mergesplit models give to merges/splits worth executing
+    approvedLabel = 'True'
+    # if set, merges/splits are only executed when the mergesplit models recommend them
+    scoreProposals = True
     # mergesplit fee to reward for proposing accepted merges/splits (inventive scheme)
     mergesplitFee = 5
+    # most neighbors a proposer ranks, sampled at random from larger networks, so choosing a merge costs
+    # about the same whatever the size of the network (None to rank every neighbor)
+    candidateSample = 32
+    # merge/split predictions cached at most (0 to disable the cache), and seconds each is kept for
+    # (simulated seconds in event mode, None to keep them until evicted)
+    cacheSize = 4096
+    cacheTTL = 30.0
+    # predictions for a community are cached under its metrics as of the last time any of them moved by more
+    # than cacheDelta (a fraction of the value); moving further invalidates them
+    cacheDelta = 0.1
+    # mergesplit models loaded so far, by path; models are loaded on first use and shared by every network
+    models = {}
+    modelsLock = Lock()
     
     def __init__(self, communities):
         # stores disjoint communties in the network
@@ -48,13 +45,16 @@ class Network:
         for i in range(len(communities)):
             community = communities[i]
             self.threads.append(Thread(target=community.run, name='Node {}'.format(i)))
-        # load mergesplit merge model
-        # self.mergeModel = PipelineModel.load(self.mergeModelPath)
-        # load mergesplit split model
-        # self.splitModel = PipelineModel.load(self.splitModelPath)
-        self.mergeModel, self.splitModel = None, None
         self.numMerges = 0 # number of executed merges
         self.numSplits = 0 # number of executed splits
+        # discrete-event simulation scheduling the communities, if not run on threads
+        self.simulation = None
+        # merge/split probabilities by (kind, model version, features), and the features each community's
+        # predictions are cached under, by community id
+        self.predictions = utils.LRUCache(Network.cacheSize, Network.cacheTTL, self.clock)
+        self.anchors = {}
+        # per-community locks, held by merges/splits and by a community producing a block
+        self.locks = utils.LockManager()
     
     def summarize(self):
         print('MergeSplit Network Summary:')
@@ -63,7 +63,7 @@ class Network:
             keys = [node.publicKey for node in community.nodes]
             print('community ' + str(community.id) + ': ' + str(keys))
             print(str(len(community.pool)) + ' transactions loaded into pool')
-            active = sum([thread.isAlive() for thread in self.threads])
+            active = sum([thread.is_alive() for thread in self.threads])
             print(str(active) + ' threads currently active')
             
     def _removeCommunity(self, id):
@@ -73,87 +73,196 @@ class Network:
                 index = i
         if index != -1:
             self.communities.pop(index)
+            self.anchors.pop(id, None)
+            if self.simulation:
+                self.simulation.retire(id)
+
+    # a community added while the network runs on threads (by a split, on a community's thread) is run on
+    # a thread of its own, which the driver joins with the others
+    def _addCommunity(self, community):
+        self.communities.append(community)
+        if self.simulation:
+            self.simulation.spawn(community)
+        elif current_thread() in self.threads:
+            thread = Thread(target=community.run, name='Node {}'.format(len(self.threads)))
+            self.threads.append(thread)
+            thread.start()
         
+    # returns the network's time: simulated seconds in event mode, wall-clock seconds otherwise
+    def clock(self):
+        return self.simulation.now if self.simulation else time.monotonic()
+
     # executes a merge proposed by proposer between community1 and community2 
+    # the communities' locks, taken by canMerge, are released once the merge finishes
     def merge(self, proposer, community1, community2):
-        # try to execute the merge
-        # returns status of operation and the new merged community if successful
-        (approved, community) = community1.merge(community2)
-        if approved:
-            # if successful, proposer accrues a mergesplit transaction fee
-            community.accrueTransactionFee(proposer)
-            self._removeCommunity(community2.getCommunityId())
-            self.numMerges += 1
+        try:
+            # try to execute the merge
+            # returns status of operation and the new merged community if successful
+            (approved, community) = community1.merge(community2)
+            if approved:
+                # if successful, proposer accrues a mergesplit transaction fee
+                community.accrueTransactionFee(proposer)
+                self._removeCommunity(community2.getCommunityId())
+                self.numMerges += 1
+        finally:
+            self.locks.release([community1.getCommunityId(), community2.getCommunityId()])
             
     # executes a split proposed by proposer for community
+    # the community's lock, taken by canSplit, is released once the split finishes
     def split(self, proposer, community):
-        # try to execute the split
-        # returns status of operation and the two split communities if successful
-        (approved, community1, community2) = community.split()
-        if approved:
-            # if successful and community1 contains the proposer
-            if community1.contains(proposer.publicKey):
-                # proposer in community1 accrues the transaction fee
-                community1.accrueTransactionFee(proposer)
-            else:
-                # proposer in community2 accrues the transaction fee
-                community2.accrueTransactionFee(proposer)
-            # remove old community from the network and add in the two new ones
-            self._removeCommunity(community.getCommunityId())
-            self.communities.append(community1)
-            self.communities.append(community2)
-            self.numSplits+= 1
+        try:
+            # try to execute the split
+            # returns status of operation and the two split communities if successful
+            # (community1 is community itself, so it keeps running under its id)
+            (approved, community1, community2) = community.split()
+            if approved:
+                # if successful and community1 contains the proposer
+                if community1.contains(proposer.publicKey):
+                    # proposer in community1 accrues the transaction fee
+                    community1.accrueTransactionFee(proposer)
+                else:
+                    # proposer in community2 accrues the transaction fee
+                    community2.accrueTransactionFee(proposer)
+                # add the nodes split off to the network as a new community
+                self._addCommunity(community2)
+                self.numSplits+= 1
+        finally:
+            self.locks.release([community.getCommunityId()])
+
+    # returns the mergesplit model saved at path, loading it the first time it is asked for
+    def loadModel(path):
+        with Network.modelsLock:
+            if path not in Network.models:
+                Network.models[path] = gbt.GBTPipeline.load(path)
+            return Network.models[path]
+
+    # returns the features the mergesplit models describe a community by: number of nodes, length of
+    # longest chain, number of forks, and total stake in system for forgers in the community
+    # (a snapshot of the community's metrics, which it keeps up to date, so no chain is walked)
+    def features(community):
+        return community.metrics.snapshot
 
     # run ML classification of merge utility (novel incentive scheme)
     def scoreMerge(self, community1, community2):
-        # store number of nodes, length of longest chain, number of forks,
-        # and total stake in system for forgers in communities to be merged
-        numberOfNodes1, longestChain1, numberOfForks1, totalStake1 = len(community1.nodes), 0, 0, 0
-        numberOfNodes2, longestChain2, numberOfForks2, totalStake2 = len(community2.nodes), 0, 0, 0
-        for node in community1.nodes:
-            longestChain1 = max(longestChain1, node.chain.lengthOfLongestChain())
-            numberOfForks1 = max(numberOfForks1, len(node.chain.chains))
-            totalStake1 += node.stake
-        for node in community2.nodes:
-            longestChain2 = max(longestChain2, node.chain.lengthOfLongestChain())
-            numberOfForks2 = max(numberOfForks2, len(node.chain.chains))
-            totalStake2 += node.stake
+        # store the features of the communities to be merged
+        numberOfNodes1, longestChain1, numberOfForks1, totalStake1 = Network.features(community1)
+        numberOfNodes2, longestChain2, numberOfForks2, totalStake2 = Network.features(community2)
         # construct the test example
-        X = np.asarray([numberOfNodes1, numberOfNodes2,
-                        longestChain1, longestChain2,
-                        numberOfForks1, numberOfForks2,
-                        totalStake1, totalStake2])
-        # run model prediction to classify merge utility
-        return self.mergeModel.predict(X)
+        model = Network.loadModel(Network.mergeModelPath)
+        X = model.vector({'numberOfNodes1': numberOfNodes1, 'numberOfNodes2': numberOfNodes2,
+                                    'longestChain1': longestChain1, 'longestChain2': longestChain2,
+                                    'numberOfForks1': numberOfForks1, 'numberOfForks2': numberOfForks2,
+                                    'totalStake1': totalStake1, 'totalStake2': totalStake2})
+        # run model prediction to classify merge utility (probability that the merge is worth executing)
+        return model.probability(X, Network.approvedLabel)
+
+    # run ML classification of merge utility for a batch of pairs given as two arrays of community
+    # features (one row per pair, as returned by features; features1 may be a single row shared by every
+    # pair), in one model call
+    def scoreMerges(self, features1, features2):
+        if not Network.scoreProposals:
+            return np.ones(len(features2))
+        model = Network.loadModel(Network.mergeModelPath)
+        names = ('numberOfNodes', 'longestChain', 'numberOfForks', 'totalStake')
+        X = np.empty((len(features2), len(model.inputCols)))
+        X[:, [model.inputCols.index(name + '1') for name in names]] = features1
+        X[:, [model.inputCols.index(name + '2') for name in names]] = features2
+        return model.probabilities(X, Network.approvedLabel)
+
+    # ranks the unlocked communities community could merge with and the mergesplit models approve,
+    # returning the k best (all if k is None) as (probability, neighbor), best first
+    # at most candidateSample neighbors are ranked
+    def mergeCandidates(self, community, k=None):
+        neighbors = [neighbor for neighbor in self.communities
+                     if neighbor != community and not self.locks.isLocked(neighbor.id)]
+        if not neighbors:
+            return []
+        if Network.candidateSample and len(neighbors) > Network.candidateSample:
+            neighbors = random.sample(neighbors, Network.candidateSample)
+        probabilities = self.predictMerges(community, neighbors)
+        order = np.argsort(-probabilities, kind='stable')[:k]
+        return [(probabilities[i], neighbors[i]) for i in order if probabilities[i] >= Network.predictionThreshold]
 
     # run ML classification of split utility (novel incentive scheme)
-    def scoreSplit(self, community):
-        # store number of nodes, length of longest chain, number of forks,
-        # and total stake in system for forgers in community to be split
-        numberOfNodes, longestChain, numberOfForks, totalStake = len(community.nodes), 0, 0, 0
-        for node in community.nodes:
-            longestChain = max(longestChain, node.chain.lengthOfLongestChain())
-            numberOfForks = max(numberOfForks, len(node.chain.chains))
-            totalStake += node.stake
+    # features are the community's features to classify (its current ones if None)
+    def scoreSplit(self, community, features=None):
+        # store the features of the community to be split
+        numberOfNodes, longestChain, numberOfForks, totalStake = features or Network.features(community)
         # construct the test example
-        X = np.asarray([numberOfNodes, longestChain, numberOfForks, totalStake])
-        # run model prediction to classify split utility
-        return self.splitModel.predict(X)
+        model = Network.loadModel(Network.splitModelPath)
+        X = model.vector({'numberOfNodes': numberOfNodes, 'longestChain': longestChain,
+                                    'numberOfForks': numberOfForks, 'totalStake': totalStake})
+        # run model prediction to classify split utility (probability that the split is worth executing)
+        return model.probability(X, Network.approvedLabel)
 
-    # validate that two communities can be merged
-    def canMerge(self, community1, community2):
+    # returns the features community's predictions are cached under: its metrics as of the last time any
+    # of them moved by more than cacheDelta, so nearby metrics share predictions
+    def cachedFeatures(self, community):
+        current = Network.features(community)
+        # (features, lowest and highest metrics they stand for)
+        anchor = self.anchors.get(community.id)
+        if anchor is not None:
+            features, low, high = anchor
+            if current is features:
+                return features
+            for (value, lowest, highest) in zip(current, low, high):
+                if value < lowest or value > highest:
+                    break
+            else:
+                return features
+        slack = [Network.cacheDelta * max(abs(value), 1) for value in current]
+        self.anchors[community.id] = (current, [value - d for (value, d) in zip(current, slack)],
+                                      [value + d for (value, d) in zip(current, slack)])
+        return current
+
+    # returns the probability of the merge of community with each of neighbors, taking them from the
+    # prediction cache and scoring the rest in one batched model call
+    def predictMerges(self, community, neighbors):
+        if not Network.scoreProposals:
+            return np.ones(len(neighbors))
+        if not Network.cacheSize:
+            return self.scoreMerges(Network.features(community),
+                                    np.array([Network.features(neighbor) for neighbor in neighbors], dtype=np.float64))
+        version = Network.loadModel(Network.mergeModelPath).version
+        features = self.cachedFeatures(community)
+        keys = [('merge', version, features, self.cachedFeatures(neighbor)) for neighbor in neighbors]
+        probabilities = np.array(self.predictions.getMany(keys, np.nan))
+        misses = np.flatnonzero(np.isnan(probabilities))
+        if len(misses):
+            probabilities[misses] = self.scoreMerges(features, np.array([keys[i][3] for i in misses], dtype=np.float64))
+            self.predictions.putMany([(keys[i], probabilities[i]) for i in misses])
+        return probabilities
+
+    # returns the probability of the split of community, from the prediction cache if it holds it
+    def predictSplit(self, community):
+        if not Network.cacheSize:
+            return self.scoreSplit(community)
+        features = self.cachedFeatures(community)
+        key = ('split', Network.loadModel(Network.splitModelPath).version, features)
+        probability = self.predictions.get(key)
+        if probability is None:
+            probability = self.scoreSplit(community, features)
+            self.predictions.put(key, probability)
+        return probability
+
+    # validate that two communities can be merged, locking both if so (merge releases them)
+    # probability is the merge's score if the caller already ranked it (see mergeCandidates)
+    def canMerge(self, community1, community2, probability=None):
         if community1 == community2:
             return False
-        if community1.isLocked or community2.isLocked:
-            return False
         # run ML model to validate the merge
-        # return self.scoreMerge(community1, community2)
-        return True
+        if Network.scoreProposals:
+            if probability is None:
+                probability = self.predictMerges(community1, [community2])[0]
+            if probability < Network.predictionThreshold:
+                return False
+        # fails without waiting if either community is being merged, split or is producing a block
+        return self.locks.tryAcquire([community1.getCommunityId(), community2.getCommunityId()])
 
-    # validate that a community can be split
+    # validate that a community can be split, locking it if so (split releases it)
     def canSplit(self, community):
-        if community.isLocked:
-            return False
         # run ML model to validate the split
-        # return self.scoreSplit(community)
-        return True
\ No newline at end of file
+        if Network.scoreProposals:
+            if self.predictSplit(community) < Network.predictionThreshold:
+                return False
+        return self.locks.tryAcquire([community.getCommunityId()])
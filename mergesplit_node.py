@@ -1,20 +1,9 @@
-import sys
-import os
-import copy
-import json
-import numbers
 from hashlib import sha256 as H
 import random
-from collections import defaultdict
-from threading import Thread
-import time
 import nacl.encoding
 import nacl.signing
 import blockchain
 import utils
-import mergesplit_community
-import mergesplit_network 
-import buildingblocks
 
 
 # implements a forger who validates blocks and adds them to the blockchain
@@ -34,8 +23,8 @@ class Node:
         self.community = community
         # node's stake in the system (for proof of stake)
         self.stake = 0
-        # reference node's blockchain
-        self.chain = blockchain.BlockChain()
+        # reference node's view of the community's shared block store
+        self.chain = blockchain.BlockChain(community.store)
 
     def setBlockChain(self, newBlockChain):
         self.chain = newBlockChain
@@ -49,50 +38,33 @@ class Node:
     # node proposal to merge a community with another in the network
     def proposeMerge(self):
         if self.network and self.network.communities:
-            neighbor = random.choice(self.network.communities)
-            if self.network.canMerge(self.community, neighbor):
-                self.community.isLocked = True
-                neighbor.isLocked = True
+            # pick the best-ranked neighbor, at random among equally ranked ones
+            candidates = self.network.mergeCandidates(self.community)
+            if not candidates:
+                return
+            probability = candidates[0][0]
+            neighbor = random.choice([neighbor for (p, neighbor) in candidates if p == probability])
+            if self.network.canMerge(self.community, neighbor, probability):
                 self.network.merge(self, self.community, neighbor)
-                self.community.isLocked = False
-                neighbor.isLocked = False
-                #pass
 
     # node proposal to split a community into two new communites in the network
     def proposeSplit(self):
         if self.network and self.network.canSplit(self.community):
-            self.community.isLocked = True
             self.network.split(self, self.community)
-            self.community.isLocked = False
             
     # checks if the transaction does not already exist on this chain
     def checkNewTransaction(self, transaction, prev):
-        current = prev
-        while current:
-            currentTransaction = utils.Utils.deserializeTransaction(current.block.tx)
-            if currentTransaction.number == transaction.number:
-                return False
-            current = current.prev
-        return True
+        return not self.chain.containsTransaction(transaction.number, prev)
     
     # checks if number is a valid hash
     def checkForValidNumber(self, transaction):
-        serializedInput = "".join([str(inp['number']) + str(inp['output']['value']) + str(inp['output']['pubkey'])
-                                   for inp in transaction.inp])
-        serializedOutput = "".join([str(out['value']) + str(out['pubkey']) for out in transaction.out])
-        h = H(str.encode(serializedInput + serializedOutput + transaction.sig)).hexdigest()
+        h = H(transaction.getMessage() + str.encode(transaction.sig)).hexdigest()
         return h == transaction.number
     
     # checks to see if each input exists on the chain for this transaction
     def checkInputsForTransaction(self, transaction, prev):
         for inp in transaction.inp:
-            current = prev
-            while current:
-                currentTransaction = utils.Utils.deserializeTransaction(current.block.tx)
-                if currentTransaction.number == inp['number']:
-                    break
-                current = current.prev
-            if not current:
+            if not self.chain.containsTransaction(inp.number, prev):
                 return False
         return True
     
@@ -102,65 +74,25 @@ class Node:
             return True
         elif not transaction.inp:
             return False
-        inp = transaction.inp[0]
-        publicKeySender = inp['output']['pubkey']
-        for i in range(len(transaction.inp)):
-            inp = transaction.inp[i]
-            if inp['output']['pubkey'] != publicKeySender:
-                return False
-            try:
-                # checks to see if public key sender can sign off on the signature of the transaction
-                serializedInput = "".join([str(inp['number']) + str(inp['output']['value']) + str(inp['output']['pubkey'])
-                                          for inp in transaction.inp])
-                serializedOutput = "".join([str(out['value']) + str(out['pubkey']) for out in transaction.out])
-                message = serializedInput + serializedOutput
-                utils.Utils.verifyWithPublicKey(publicKeySender, message, transaction.sig)
-            except:
+        publicKeySender = transaction.inp[0].pubkey
+        for inp in transaction.inp:
+            if inp.pubkey != publicKeySender:
                 return False
-        return True
+        # checks to see if public key sender can sign off on the signature of the transaction
+        return utils.Utils.verifyTransaction(publicKeySender, transaction)
     
     # check whether each output actually exists in the named transaction
     def checkOutputExistsForInput(self, transaction, prev):
+        unspent = self.chain.unspentAt(prev)
         for inp in transaction.inp:
-            current = prev
-            while current:
-                currentTransaction = utils.Utils.deserializeTransaction(current.block.tx)
-                if currentTransaction.number == inp['number']:
-                    break
-                current = current.prev
-            if current:
-                currentTransaction = utils.Utils.deserializeTransaction(current.block.tx)
-                found = False
-                for out in currentTransaction.out:
-                    if (out['value'] == inp['output']['value']
-                            and out['pubkey'] == inp['output']['pubkey']):
-                        found = True
-                        break
-                if not found:
-                    return False
-            else:
+            if not unspent.contains(inp.number, inp.value, inp.pubkey):
                 return False
         return True
     
     # check for existence of double spend using this transaction along a chain
+    # an input is a double spend if its output is no longer unspent at prev
     def checkNoDoubleSpend(self, transaction, prev):
-        for inp in transaction.inp:
-            current = prev
-            # iterate back along the chain for each input in the transaction
-            while current:
-                currentTransaction = utils.Utils.deserializeTransaction(current.block.tx)
-                if currentTransaction.number == inp['number']:
-                    break
-                # check if an input along the chain matches the transaction input
-                for currentInp in currentTransaction.inp:
-                    if (currentInp['number'] == inp['number']
-                        and currentInp['output']['pubkey'] == inp['output']['pubkey']
-                            and currentInp['output']['value'] == inp['output']['value']):
-                        # we are trying to spend coins that were already sent off
-                        # this is a double spend
-                        return False
-                current = current.prev
-        return True
+        return self.chain.unspentAt(prev).canSpend(transaction.inp)
     
     # checks for sum of inputs into a transaction matching sum of outputs leaving it
     def checkInputEqualsOutput(self, transaction, isFee=False):
@@ -168,9 +100,9 @@ class Node:
             return True
         inputSum, outputSum = 0, 0
         for inp in transaction.inp:
-            inputSum += inp['output']['value']
+            inputSum += inp.value
         for out in transaction.out:
-            outputSum += out['value']
+            outputSum += out.value
         return inputSum == outputSum
     
     # checks if a transaction is valid when being added to a chain
@@ -185,23 +117,48 @@ class Node:
                 and self.checkInputEqualsOutput(transaction, isFee)
         )
     
+    # checks if a batch of transactions can be added together to a chain
+    # each must be valid at prev on its own, and together they may not repeat a number or an output
+    def validateBatch(self, transactions, prev, isFee=False):
+        for i in range(len(transactions)):
+            if (not self.validate(transactions[i], prev, isFee)
+                    or not self.canJoinBatch(transactions[:i], transactions[i], prev)):
+                return False
+        return True
+
+    # checks that a transaction does not conflict with a batch already chosen for a block at prev
+    def canJoinBatch(self, batch, transaction, prev):
+        if not batch:
+            return True
+        for other in batch:
+            if other.number == transaction.number:
+                return False
+        inputs = [inp for other in batch + [transaction] for inp in other.inp]
+        return self.chain.unspentAt(prev).canSpend(inputs)
+    
     # check if a transaction exists in pool that could be added to longest chain
     def validTransactionExists(self):
         for transaction in self.community.pool:
-            tx = utils.Utils.serializeTransaction(transaction)
             if self.validate(transaction, self.chain.longestChain()):
                 return True
         return False
     
     # verifies whether a proposed block can be added to the blockchain
-    def verifyProposal(self, proposedBlock):
-        tx = utils.Utils.deserializeTransaction(proposedBlock.tx)
-        # next verify if this block can be added to a chain
-        # and if the transaction contained in the block is valid
-        if (self.chain.isValidPrev(proposedBlock.prev)
-                and self.validate(tx, self.chain.blockToNode[proposedBlock.prev], proposedBlock.isFee)):
-            return True
-        return False
+    # verdicts (optional) maps (block hash, prev hash, isFee) to a result reached by another node;
+    # block hashes commit to the whole history behind prev, so the result holds for any node that has prev
+    def verifyProposal(self, proposedBlock, verdicts=None):
+        # first verify that this block extends one of this node's chains
+        if not self.chain.isValidPrev(proposedBlock.prev):
+            return False
+        key = (proposedBlock.getHash(), proposedBlock.prev, proposedBlock.isFee)
+        if verdicts is not None and key in verdicts:
+            return verdicts[key]
+        txs = proposedBlock.getTransactions()
+        # next verify if the transactions contained in the block are valid together
+        verdict = self.validateBatch(txs, self.chain.getNode(proposedBlock.prev), proposedBlock.isFee)
+        if verdicts is not None:
+            verdicts[key] = verdict
+        return verdict
 
     # node gives approval for a split request
     def approveSplit(self, proposal=None):
@@ -0,0 +1,321 @@
+import os
+import random
+import itertools
+import multiprocessing
+import queue
+from threading import Thread, Event, Lock, current_thread
+import numpy as np
+import utils
+import mergesplit_network
+
+
+# implements request/reply messaging for one worker process
+# every message is (kind, payload, sender, requestId); replies are matched back to the thread waiting on them
+class Channel:
+
+    def __init__(self, index, requests, replies, coordinator):
+        # index of the worker this channel belongs to
+        self.index = index
+        # request queue of every worker, indexed by worker
+        self.requests = requests
+        # reply queue of every worker, indexed by worker
+        self.replies = replies
+        # queue read by the coordinator in the parent process
+        self.coordinator = coordinator
+        # request id -> [Event set on reply, reply]
+        self.pending = {}
+        self.counter = itertools.count()
+        self.lock = Lock()
+
+    # sends a request and blocks until its reply arrives
+    def call(self, target, kind, payload):
+        waiter = [Event(), None]
+        with self.lock:
+            requestId = next(self.counter)
+            self.pending[requestId] = waiter
+        target.put((kind, payload, self.index, requestId))
+        waiter[0].wait()
+        return waiter[1]
+
+    # sends a message that needs no reply
+    def send(self, target, kind, payload):
+        target.put((kind, payload, self.index, None))
+
+    # answers a request from another worker
+    def reply(self, requester, requestId, result):
+        self.replies[requester].put((requestId, result))
+
+    # hands each reply to the thread waiting on it, until a reply with no request id arrives
+    def dispatch(self):
+        while True:
+            requestId, result = self.replies[self.index].get()
+            if requestId is None:
+                return
+            with self.lock:
+                waiter = self.pending.pop(requestId)
+            waiter[1] = result
+            waiter[0].set()
+
+
+# implements a stand-in for a community run by another worker process
+# merge requests against it are answered by the owning worker
+class RemoteCommunity:
+
+    def __init__(self, id, owner, channel):
+        self.id = id
+        self.owner = owner
+        self.channel = channel
+
+    def getCommunityId(self):
+        return self.id
+
+    def mergeSnapshot(self):
+        snapshot = self.channel.call(self.channel.requests[self.owner], 'snapshot', self.id)
+        if isinstance(snapshot, Exception):
+            raise snapshot
+        return snapshot
+
+
+# implements the network as seen from inside a worker process
+# the worker's own communities are used directly; the list of live communities and
+# merge/split locks are held by the coordinator in the parent process
+class RemoteNetwork(mergesplit_network.Network):
+
+    def __init__(self, channel, communities):
+        self.channel = channel
+        # communities run (or created by splits) in this worker, by id
+        self.local = {}
+        for community in communities:
+            self._register(community)
+        self.threads = [Thread(target=community.run, name='Community {}'.format(community.id))
+                        for community in communities]
+        self.numMerges = 0
+        self.numSplits = 0
+        # workers run their communities on threads, on the wall clock
+        self.simulation = None
+        # merge/split predictions of this worker's communities, cached as in Network
+        self.predictions = utils.LRUCache(mergesplit_network.Network.cacheSize, mergesplit_network.Network.cacheTTL,
+                                          self.clock)
+        self.anchors = {}
+        # locks of this worker's communities, held by merges/splits it runs and by its communities
+        # producing blocks
+        self.locks = utils.LockManager()
+
+    def _register(self, community):
+        self.local[community.id] = community
+        community.network = self
+        for node in community.nodes:
+            node.network = self
+
+    # live communities across all workers, in network order
+    @property
+    def communities(self):
+        listing = self.channel.call(self.channel.coordinator, 'communities', None)
+        return [self.local[id] if owner == self.channel.index else RemoteCommunity(id, owner, self.channel)
+                for (id, owner) in listing]
+
+    def _removeCommunity(self, id):
+        self.channel.send(self.channel.coordinator, 'remove', id)
+
+    # a community created by a split runs on a thread of its own in this worker, like in thread mode
+    def _addCommunity(self, community):
+        self._register(community)
+        self.channel.send(self.channel.coordinator, 'add', (community.id, self.channel.index))
+        if current_thread() in self.threads:
+            thread = Thread(target=community.run, name='Community {}'.format(community.id))
+            self.threads.append(thread)
+            thread.start()
+
+    # lock the communities at the coordinator, failing if any is locked or no longer in the network,
+    # and in this worker, failing if any is producing a block
+    def _lock(self, ids):
+        if not self.channel.call(self.channel.coordinator, 'lock', ids):
+            return False
+        if self.locks.tryAcquire(ids):
+            return True
+        self._unlock(ids)
+        return False
+
+    def _unlock(self, ids):
+        self.channel.send(self.channel.coordinator, 'unlock', ids)
+
+    # ranks at most candidateSample neighbors as Network does, except that communities run by other workers
+    # cannot be scored from this worker: this worker's unlocked neighbors the models approve come first,
+    # best first, then the others in random order, all ranked at the prediction threshold so that the
+    # coordinator's locks decide between them
+    def mergeCandidates(self, community, k=None):
+        neighbors = [neighbor for neighbor in self.communities
+                     if neighbor.getCommunityId() != community.getCommunityId()]
+        if mergesplit_network.Network.candidateSample and len(neighbors) > mergesplit_network.Network.candidateSample:
+            neighbors = random.sample(neighbors, mergesplit_network.Network.candidateSample)
+        local = [neighbor for neighbor in neighbors
+                 if neighbor.id in self.local and not self.locks.isLocked(neighbor.id)]
+        remote = [neighbor for neighbor in neighbors if neighbor.id not in self.local]
+        random.shuffle(remote)
+        candidates = []
+        if local:
+            probabilities = self.predictMerges(community, local)
+            order = np.argsort(-probabilities, kind='stable')
+            candidates = [(probabilities[i], local[i]) for i in order
+                          if probabilities[i] >= mergesplit_network.Network.predictionThreshold]
+        threshold = 1.0
+        if mergesplit_network.Network.scoreProposals:
+            threshold = mergesplit_network.Network.predictionThreshold
+        candidates += [(threshold, neighbor) for neighbor in remote]
+        return candidates[:k]
+
+    # merges are scored as in Network, except a merge with another worker's community, which can only be
+    # scored by mergeCandidates' probability
+    def canMerge(self, community1, community2, probability=None):
+        if community1.getCommunityId() == community2.getCommunityId():
+            return False
+        if mergesplit_network.Network.scoreProposals:
+            if probability is None and community2.getCommunityId() in self.local:
+                probability = self.predictMerges(community1, [community2])[0]
+            if probability is not None and probability < mergesplit_network.Network.predictionThreshold:
+                return False
+        return self._lock([community1.getCommunityId(), community2.getCommunityId()])
+
+    # splits are scored as in Network before any lock is asked for
+    def canSplit(self, community):
+        if mergesplit_network.Network.scoreProposals:
+            if self.predictSplit(community) < mergesplit_network.Network.predictionThreshold:
+                return False
+        return self._lock([community.getCommunityId()])
+
+    # locks taken by canMerge/canSplit are released once the operation finishes
+    # (this worker's by Network.merge/split, the coordinator's here)
+    def merge(self, proposer, community1, community2):
+        try:
+            mergesplit_network.Network.merge(self, proposer, community1, community2)
+        finally:
+            self._unlock([community1.getCommunityId(), community2.getCommunityId()])
+
+    def split(self, proposer, community):
+        try:
+            mergesplit_network.Network.split(self, proposer, community)
+        finally:
+            self._unlock([community.getCommunityId()])
+
+    # answers merge snapshot requests for this worker's communities until told to stop
+    def serve(self):
+        while True:
+            kind, payload, requester, requestId = self.channel.requests[self.channel.index].get()
+            if kind == 'stop':
+                return
+            if kind == 'snapshot':
+                # the community's lock here keeps it from producing a block while its snapshot is taken
+                self.locks.acquire(payload)
+                # a failed snapshot is raised in the requesting thread, as it would be when run locally
+                try:
+                    result = self.local[payload].mergeSnapshot()
+                except Exception as error:
+                    result = error
+                finally:
+                    self.locks.release([payload])
+                self.channel.reply(requester, requestId, result)
+
+
+# entry point of a worker process: runs its communities on threads, then reports back
+def _work(index, communities, requests, replies, coordinator, seed):
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    channel = Channel(index, requests, replies, coordinator)
+    network = RemoteNetwork(channel, communities)
+    dispatcher = Thread(target=channel.dispatch)
+    server = Thread(target=network.serve)
+    dispatcher.start()
+    server.start()
+    try:
+        # threads of communities split off while starting are already running
+        for thread in list(network.threads):
+            thread.start()
+        for thread in network.threads:
+            thread.join()
+    finally:
+        # keep answering other workers until every worker is done
+        channel.send(coordinator, 'idle', None)
+        server.join()
+        replies[index].put((None, None))
+        dispatcher.join()
+    # queues cannot be pickled, so detach the network before sending communities back
+    local = list(network.local.values())
+    for community in local:
+        community.network = None
+        for node in community.nodes:
+            node.network = None
+    channel.send(coordinator, 'result', (local, network.numMerges, network.numSplits,
+                                         network.predictions.hits, network.predictions.misses))
+
+
+# runs the network's communities in worker processes and merges the results back into network
+# the calling process coordinates: it owns the list of live communities and the merge/split locks
+def simulate(network, workers=None):
+    communities = network.communities
+    workers = max(1, min(workers or os.cpu_count() or 1, len(communities)))
+    context = multiprocessing.get_context()
+    requests = [context.Queue() for i in range(workers)]
+    replies = [context.Queue() for i in range(workers)]
+    coordinator = context.Queue()
+    # community k is run by worker k % workers
+    alive = [(communities[k].id, k % workers) for k in range(len(communities))]
+    for community in communities:
+        community.network = None
+        for node in community.nodes:
+            node.network = None
+    processes = []
+    for i in range(workers):
+        args = (i, communities[i::workers], requests, replies, coordinator, random.randrange(2**32))
+        processes.append(context.Process(target=_work, args=args, name='Worker {}'.format(i)))
+    for process in processes:
+        process.start()
+
+    locks, idle, results = utils.LockManager(), 0, {}
+    while len(results) < workers:
+        try:
+            kind, payload, sender, requestId = coordinator.get(timeout=1)
+        except queue.Empty:
+            for i in range(workers):
+                if i not in results and not processes[i].is_alive():
+                    raise RuntimeError('worker ' + str(i) + ' exited without reporting its communities')
+            continue
+        if kind == 'communities':
+            replies[sender].put((requestId, list(alive)))
+        elif kind == 'lock':
+            live = set([id for (id, owner) in alive])
+            granted = all([id in live for id in payload]) and locks.tryAcquire(payload)
+            replies[sender].put((requestId, granted))
+        elif kind == 'unlock':
+            locks.release(payload)
+        elif kind == 'remove':
+            alive = [(id, owner) for (id, owner) in alive if id != payload]
+        elif kind == 'add':
+            alive.append(payload)
+        elif kind == 'idle':
+            idle += 1
+            if idle == workers:
+                for request in requests:
+                    request.put(('stop', None, None, None))
+        elif kind == 'result':
+            results[sender] = payload
+    for process in processes:
+        process.join()
+
+    # rebuild the network from the communities still alive, and aggregate counters
+    # (including the lookups of every worker's prediction cache)
+    byId = {}
+    for (local, numMerges, numSplits, hits, misses) in results.values():
+        for community in local:
+            byId[community.id] = community
+        network.numMerges += numMerges
+        network.numSplits += numSplits
+        network.predictions.hits += hits
+        network.predictions.misses += misses
+    # contention between workers for merge/split locks
+    network.locks = locks
+    network.communities = [byId[id] for (id, owner) in alive]
+    for community in network.communities:
+        community.network = network
+        for node in community.nodes:
+            node.network = network
+    return network
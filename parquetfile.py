@@ -0,0 +1,375 @@
+import os
+import struct
+
+
+# implements a small reader for the Parquet files Spark saves models in, so models load without Spark
+# reads with pyarrow when it is installed, and otherwise decodes the files itself, covering only what Spark
+# writes for the bundled models' stage data: snappy compressed v1 data pages and dictionary pages of PLAIN
+# or dictionary encoded INT32, DOUBLE and UTF8 columns, within optional structs and single-level lists
+# (a LIST group holding a repeated 'list' group of single elements); anything else raises a ValueError
+
+# physical types
+INT32, DOUBLE, BYTE_ARRAY = 1, 5, 6
+# repetition types
+REQUIRED, OPTIONAL, REPEATED = range(3)
+# converted types
+UTF8, LIST = 0, 3
+# page types
+DATA_PAGE, DICTIONARY_PAGE = 0, 2
+# encodings
+PLAIN, PLAIN_DICTIONARY, RLE = 0, 2, 3
+# compression codecs
+SNAPPY = 1
+
+MAGIC = b'PAR1'
+
+
+# returns the rows of a Parquet file, or of every part file of a directory Spark wrote, as dicts
+def read(path):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return ParquetFile.readPath(path)
+    return pyarrow.parquet.read_table(path).to_pylist()
+
+
+# decompresses a snappy block made of literals and copies with 1 or 2 byte offsets
+# (4 byte offsets only occur in blocks over 64KB, larger than the pages of the bundled models)
+def snappyDecompress(data):
+    length, i = _varint(data, 0)
+    out = bytearray()
+    while i < len(data):
+        tag = data[i]
+        kind = tag & 3
+        i += 1
+        if kind == 0:
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = int.from_bytes(data[i:i+size], 'little')
+                i += size
+            n += 1
+            out += data[i:i+n]
+            i += n
+            continue
+        if kind == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[i]
+            i += 1
+        elif kind == 2:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[i:i+2], 'little')
+            i += 2
+        else:
+            raise ValueError('Unsupported snappy copy with a 4 byte offset')
+        start = len(out) - offset
+        if offset <= 0 or start < 0:
+            raise ValueError('Corrupt snappy block')
+        if offset >= n:
+            out += out[start:start+n]
+        else:
+            # the copy overlaps its own output
+            for k in range(n):
+                out.append(out[start+k])
+    if len(out) != length:
+        raise ValueError('Corrupt snappy block')
+    return bytes(out)
+
+def _varint(data, i):
+    result, shift = 0, 0
+    while True:
+        byte = data[i]
+        i += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, i
+        shift += 7
+
+
+# implements the Thrift compact protocol Parquet metadata is written in, for the value types the metadata of
+# the bundled models uses (booleans, integers, binary, lists and structs)
+# structs are read into dicts keyed by field id
+class ThriftReader:
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def varint(self):
+        value, self.position = _varint(self.data, self.position)
+        return value
+
+    def zigzag(self):
+        value = self.varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def value(self, kind):
+        if kind == 1:
+            return True
+        if kind == 2:
+            return False
+        if kind in (4, 5, 6):
+            return self.zigzag()
+        if kind == 8:
+            n = self.varint()
+            self.position += n
+            return bytes(self.data[self.position-n:self.position])
+        if kind == 9:
+            return self.list()
+        if kind == 12:
+            return self.struct()
+        raise ValueError('Unsupported thrift type ' + str(kind))
+
+    def list(self):
+        header = self.data[self.position]
+        self.position += 1
+        size, kind = header >> 4, header & 0x0f
+        if size == 15:
+            size = self.varint()
+        if kind in (1, 2):
+            # booleans in lists take a byte each
+            values = [self.data[self.position+k] == 1 for k in range(size)]
+            self.position += size
+            return values
+        return [self.value(kind) for k in range(size)]
+
+    def struct(self):
+        fields, field = {}, 0
+        while True:
+            header = self.data[self.position]
+            self.position += 1
+            if header == 0:
+                return fields
+            delta, kind = header >> 4, header & 0x0f
+            field = field + delta if delta else self.zigzag()
+            fields[field] = self.value(kind)
+
+
+# represents a column of the schema (a leaf), with the schema elements on its path from the root
+class Column:
+
+    def __init__(self, path):
+        # schema elements (Thrift field dicts) from below the root down to the leaf
+        self.path = path
+        self.names = [element[4].decode() for element in path]
+        self.type = path[-1].get(1)
+        if self.type not in (INT32, DOUBLE, BYTE_ARRAY) or (self.type == BYTE_ARRAY and path[-1].get(6) != UTF8):
+            raise ValueError('Unsupported Parquet column type for ' + '.'.join(self.names))
+        repetition = [element.get(3, REQUIRED) for element in path]
+        self.maxDefinition = sum(1 for r in repetition if r != REQUIRED)
+        # index in path of the repeated 'list' group, if the column is the element of a list
+        self.repeated = None
+        if REPEATED in repetition:
+            r = repetition.index(REPEATED)
+            if r != len(path) - 2 or r == 0 or path[r-1].get(6) != LIST or REPEATED in repetition[r+1:]:
+                raise ValueError('Unsupported repeated column ' + '.'.join(self.names) +
+                                 ' (only single-level lists of values are read)')
+            self.repeated = r
+        # definition level reached once each element of path is present
+        self.levels = []
+        level = 0
+        for r in repetition:
+            level += r != REQUIRED
+            self.levels.append(level)
+
+
+# implements decoding of one Parquet file
+class ParquetFile:
+
+    def __init__(self, data):
+        if data[:4] != MAGIC or data[-4:] != MAGIC:
+            raise ValueError('Not a Parquet file')
+        length = struct.unpack_from('<I', data, len(data)-8)[0]
+        self.data = data
+        self.metadata = ThriftReader(data, len(data)-8-length).struct()
+        self.columns = self._columns(self.metadata[2])
+
+    # reads the rows of a file, or of the part files in a directory in name order
+    def readPath(path):
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.endswith('.parquet') and not name.startswith('.'))
+        else:
+            files = [path]
+        rows = []
+        for filename in files:
+            with open(filename, 'rb') as f:
+                rows += ParquetFile(f.read()).rows()
+        return rows
+
+    # flattens the schema into its leaf columns
+    def _columns(self, schema):
+        columns, stack = [], []
+        # (element, children left) of the open groups, below the root
+        for element in schema[1:]:
+            path = [e for (e, left) in stack] + [element]
+            children = element.get(5, 0)
+            if children:
+                stack.append([element, children])
+            else:
+                columns.append(Column(path))
+                while stack:
+                    stack[-1][1] -= 1
+                    if stack[-1][1]:
+                        break
+                    stack.pop()
+        return columns
+
+    # returns every row of the file
+    def rows(self):
+        rows = []
+        for group in self.metadata.get(4, []):
+            count = group[3]
+            groupRows = [{} for k in range(count)]
+            for column, chunk in zip(self.columns, group[1]):
+                values = self._rowValues(column, *self._readChunk(column, chunk[3]))
+                for row, value in zip(groupRows, values):
+                    self._place(row, column, value)
+            rows += groupRows
+        return rows
+
+    # reads the repetition levels, definition levels and non-null values of a column chunk
+    def _readChunk(self, column, meta):
+        if meta.get(4) != SNAPPY:
+            raise ValueError('Unsupported Parquet compression codec ' + str(meta.get(4)))
+        total = meta[5]
+        position = meta.get(11) or meta[9]
+        dictionary = None
+        repetitions, definitions, values = [], [], []
+        while len(definitions) < total:
+            reader = ThriftReader(self.data, position)
+            header = reader.struct()
+            start = reader.position
+            position = start + header[3]
+            page = snappyDecompress(self.data[start:position])
+            kind = header[1]
+            if kind == DICTIONARY_PAGE:
+                if header[7][2] not in (PLAIN, PLAIN_DICTIONARY):
+                    raise ValueError('Unsupported Parquet dictionary encoding ' + str(header[7][2]))
+                dictionary, _ = self._plain(page, 0, column, header[7][1])
+            elif kind == DATA_PAGE:
+                # levels are RLE/bit-packed hybrid encoded (absent levels may be labelled otherwise)
+                if (column.maxDefinition and header[5][3] != RLE) or (column.repeated and header[5][4] != RLE):
+                    raise ValueError('Unsupported Parquet level encoding')
+                n = header[5][1]
+                i = 0
+                levels, i = self._levels(page, i, 1 if column.repeated is not None else 0, n)
+                repetitions += levels
+                levels, i = self._levels(page, i, column.maxDefinition, n)
+                definitions += levels
+                values += self._values(page, i, column, header[5][2], levels, dictionary)
+            else:
+                raise ValueError('Unsupported Parquet page type ' + str(kind))
+        return repetitions, definitions, values
+
+    # reads n levels of at most maximum, which are absent when maximum is 0, prefixed with their length in bytes
+    def _levels(self, page, i, maximum, n):
+        if maximum == 0:
+            return [0] * n, i
+        end = i + 4 + struct.unpack_from('<I', page, i)[0]
+        return self._hybrid(page, i + 4, end, maximum.bit_length(), n), end
+
+    # decodes n values of the RLE/bit-packed hybrid encoding between i and end
+    def _hybrid(self, page, i, end, width, n):
+        values = []
+        byteWidth = (width + 7) // 8
+        while len(values) < n and i < end:
+            header, i = _varint(page, i)
+            if header & 1:
+                groups = header >> 1
+                bits = int.from_bytes(page[i:i+groups*width], 'little')
+                i += groups * width
+                mask = (1 << width) - 1
+                values += [(bits >> (k * width)) & mask for k in range(groups * 8)]
+            else:
+                value = int.from_bytes(page[i:i+byteWidth], 'little')
+                i += byteWidth
+                values += [value] * (header >> 1)
+        if len(values) < n:
+            raise ValueError('Corrupt Parquet levels or dictionary indices')
+        return values[:n]
+
+    # decodes the non-null values of a page
+    def _values(self, page, i, column, encoding, definitions, dictionary):
+        count = sum(1 for d in definitions if d == column.maxDefinition)
+        if encoding == PLAIN:
+            return self._plain(page, i, column, count)[0]
+        if encoding == PLAIN_DICTIONARY:
+            if count == 0:
+                return []
+            if dictionary is None:
+                raise ValueError('Dictionary encoded Parquet page without a dictionary')
+            width = page[i]
+            return [dictionary[k] for k in self._hybrid(page, i+1, len(page), width, count)]
+        raise ValueError('Unsupported Parquet encoding ' + str(encoding))
+
+    # decodes count PLAIN values
+    def _plain(self, page, i, column, count):
+        if column.type != BYTE_ARRAY:
+            code = 'i' if column.type == INT32 else 'd'
+            return list(struct.unpack_from('<%d%s' % (count, code), page, i)), i + struct.calcsize(code) * count
+        values = []
+        for k in range(count):
+            n = struct.unpack_from('<I', page, i)[0]
+            i += 4
+            values.append(bytes(page[i:i+n]).decode())
+            i += n
+        return values, i
+
+    # groups a column's levels and values into one value per row
+    # a value is the leaf value (None if the leaf is null), or for a list column the list of its element
+    # values; Missing(depth) stands for a null element of the path at that depth
+    def _rowValues(self, column, repetitions, definitions, values):
+        values = iter(values)
+        rows = []
+        for r, d in zip(repetitions, definitions):
+            if d == column.maxDefinition:
+                value = next(values)
+            else:
+                # depth of the first element on the path that is missing
+                value = Missing(next(k for k, level in enumerate(column.levels) if level > d))
+            if column.repeated is None:
+                rows.append(value)
+            elif r == 0:
+                # a new row: its list is empty or missing unless the repeated element is present
+                if isinstance(value, Missing) and value.depth <= column.repeated:
+                    rows.append(value)
+                else:
+                    rows.append([value])
+            else:
+                rows[-1].append(value)
+        return rows
+
+    # stores a column's value for a row in the row's nested dicts
+    # a list is stored under the name of its LIST group, as the list of its elements (None for null ones)
+    def _place(self, row, column, value):
+        names = column.names
+        if column.repeated is None:
+            self._set(row, names, value)
+            return
+        top = column.repeated - 1
+        if isinstance(value, Missing):
+            if value.depth < top:
+                self._set(row, names, value)
+            else:
+                # a null LIST group, or one without elements
+                self._set(row, names[:top+1], None if value.depth == top else [])
+            return
+        self._set(row, names[:top+1], [None if isinstance(v, Missing) else v for v in value])
+
+    def _set(self, row, names, value):
+        for depth, name in enumerate(names[:-1]):
+            if row.get(name, {}) is None:
+                return
+            if isinstance(value, Missing) and value.depth == depth:
+                row[name] = None
+                return
+            row = row.setdefault(name, {})
+        row[names[-1]] = None if isinstance(value, Missing) else value
+
+
+# marks a null element of a column's path
+class Missing:
+
+    def __init__(self, depth):
+        self.depth = depth
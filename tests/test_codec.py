@@ -0,0 +1,67 @@
+import io
+import codec
+import buildingblocks
+
+
+hashes = ['%064x' % (k * 0x9e3779b97f4a7c15) for k in range(1, 9)]
+signature = 'ab' * 64
+
+
+def transaction(inp, out, number=hashes[0], sig=signature):
+    return buildingblocks.Transaction(number, tuple(inp), tuple(out), sig)
+
+
+def roundTrip(tx):
+    binary = codec.BinaryCodec()
+    decoded = binary.decodeTransaction(binary.encodeTransaction(tx))
+    assert (decoded.number, decoded.inp, decoded.out, decoded.sig) == (tx.number, tx.inp, tx.out, tx.sig)
+    # the encoding is canonical: encoding the decoded transaction gives the same bytes
+    assert binary.encodeTransaction(decoded) == binary.encodeTransaction(tx)
+    return decoded
+
+
+def test_transaction_with_hash_columns():
+    tx = transaction([buildingblocks.Input(hashes[1], 10, hashes[2]), buildingblocks.Input(hashes[3], 0, hashes[2])],
+                     [buildingblocks.Output(7, hashes[4]), buildingblocks.Output(-(1 << 63), hashes[5])])
+    roundTrip(tx)
+
+
+def test_transaction_with_empty_inputs_or_outputs():
+    # genesis and fee transactions have no inputs; split transactions may have no outputs
+    roundTrip(transaction([], [buildingblocks.Output(5, hashes[1])]))
+    roundTrip(transaction([buildingblocks.Input(hashes[1], 5, hashes[2])], []))
+    roundTrip(transaction([], []))
+
+
+def test_transaction_fields_that_are_not_hashes_or_ints():
+    tx = transaction([buildingblocks.Input('not a hash', 1.5, hashes[1]),
+                      buildingblocks.Input(hashes[2], True, 'ABCD')],
+                     [buildingblocks.Output(1 << 70, 'beef'), buildingblocks.Output(-3, hashes[3].upper())],
+                     number=None, sig='')
+    decoded = roundTrip(tx)
+    assert type(decoded.inp[0].value) is float and type(decoded.inp[1].value) is bool
+    assert decoded.out[0].value == 1 << 70
+
+
+def test_block_round_trip():
+    binary = codec.BinaryCodec()
+    txs = [binary.encodeTransaction(transaction([], [buildingblocks.Output(k, hashes[k])])) for k in range(3)]
+    for prev in (hashes[6], None, 'arbitrary nonce'):
+        for blockTxs in (txs, txs[:1], []):
+            block = binary.decodeBlock(binary.encodeBlock(buildingblocks.Block(blockTxs, prev)))
+            assert block.prev == prev and block.txs == blockTxs
+
+
+def test_header_distinguishes_missing_prev():
+    binary = codec.BinaryCodec()
+    assert binary.encodeHeader(hashes[0], None) != binary.encodeHeader(hashes[0], '')
+    assert binary.encodeHeader(hashes[0], hashes[1]) != binary.encodeHeader(hashes[1], hashes[0])
+
+
+def test_chain_log_round_trip():
+    binary = codec.BinaryCodec()
+    chain = [(hashes[2], hashes[1]), (hashes[1], None)]
+    fork = [(hashes[3], hashes[1])]
+    out = io.BytesIO()
+    binary.writeChainLog(out, 3, (2, chain), [(1, 1, 1, fork)])
+    assert binary.readChainLog(io.BytesIO(out.getvalue())) == (3, chain, [(1, 1, fork)])
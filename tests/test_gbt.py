@@ -0,0 +1,58 @@
+import math
+import os
+import numpy as np
+import gbt
+import parquetfile
+
+
+models = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+paths = [os.path.join(models, 'spark-merge-model'), os.path.join(models, 'spark-split-model')]
+# the bundled models were trained on one label only, and give every example this probability of it
+knownProbability = 0.9341221756527825
+
+
+# the margin of x, walking the trees as read from the stage data rather than gbt's flattened arrays
+def walkedMargin(path, x):
+    stage = [os.path.join(path, 'stages', name) for name in os.listdir(os.path.join(path, 'stages'))
+             if 'GBTClassifier' in name][0]
+    trees = {}
+    for row in parquetfile.ParquetFile.readPath(os.path.join(stage, 'data')):
+        trees.setdefault(row['treeID'], {})[row['nodeData']['id']] = row['nodeData']
+    weights = {row['treeID']: row['weights']
+               for row in parquetfile.ParquetFile.readPath(os.path.join(stage, 'treesMetadata'))}
+    total = 0.0
+    for treeID, nodes in trees.items():
+        node = nodes[0]
+        while node['leftChild'] != -1:
+            split = node['split']
+            goLeft = x[split['featureIndex']] <= split['leftCategoriesOrThreshold'][0]
+            node = nodes[node['leftChild'] if goLeft else node['rightChild']]
+        total += weights[treeID] * node['prediction']
+    return total
+
+
+def test_models_give_their_known_outputs():
+    for path in paths:
+        model = gbt.GBTPipeline.load(path)
+        x = [1.0] * len(model.inputCols)
+        assert model.labels == ['True']
+        assert math.isclose(model.margin(x), walkedMargin(path, x), rel_tol=1e-12)
+        assert math.isclose(model.probability(x, 'True'), knownProbability, rel_tol=1e-12)
+        assert model.probability(x, 'False') == 0.0
+
+
+def test_batch_and_single_scoring_agree():
+    rng = np.random.default_rng(0)
+    for path in paths:
+        model = gbt.GBTPipeline.load(path)
+        # values around the trees' thresholds, so every branch is taken
+        X = rng.integers(0, 120, size=(200, len(model.inputCols))).astype(np.float64)
+        X[::7] += 0.5
+        batch = model.probabilities(X, 'True')
+        single = [model.probability(x, 'True') for x in X.tolist()]
+        assert np.allclose(batch, single, rtol=0, atol=1e-12)
+        assert np.allclose(batch, knownProbability, rtol=0, atol=1e-12)
+        # small batches take the pure Python path
+        assert np.allclose(model.probabilities(X[:3], 'True'), single[:3], rtol=0, atol=1e-12)
+        margins = model.margins(X[:20])
+        assert np.allclose(margins, [walkedMargin(path, x) for x in X[:20].tolist()], rtol=0, atol=1e-12)
@@ -0,0 +1,87 @@
+import glob
+import os
+import pytest
+import parquetfile
+
+
+models = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+
+# a literal, then a copy with a 1 byte offset overlapping its own output (run-length style)
+def test_snappy_literal_and_overlapping_copy():
+    data = bytes([7, 0 << 2, ord('a'), (2 << 2) | 1, 1])
+    assert parquetfile.snappyDecompress(data) == b'a' * 7
+
+
+# a literal whose length follows the tag, then a copy with a 2 byte offset
+def test_snappy_long_literal_and_two_byte_offset_copy():
+    literal = bytes(range(70))
+    data = bytes([70 + 3, 60 << 2, 69]) + literal + bytes([(2 << 2) | 2, 70, 0])
+    assert parquetfile.snappyDecompress(data) == literal + literal[:3]
+
+
+def test_snappy_rejects_four_byte_offsets_and_corrupt_blocks():
+    with pytest.raises(ValueError):
+        parquetfile.snappyDecompress(bytes([5, 0, ord('a'), (3 << 2) | 3, 1, 0, 0, 0]))
+    # declares 5 bytes, holds 1
+    with pytest.raises(ValueError):
+        parquetfile.snappyDecompress(bytes([5, 0, ord('a')]))
+    # copies from before the start of the output
+    with pytest.raises(ValueError):
+        parquetfile.snappyDecompress(bytes([5, (0 << 2) | 1, 4]))
+
+
+def test_reads_string_indexer_labels():
+    for path in glob.glob(os.path.join(models, '*', 'stages', '*StringIndexer*', 'data')):
+        assert parquetfile.ParquetFile.readPath(path) == [{'labels': ['True']}]
+
+
+def test_reads_gbt_trees_with_nested_structs_and_lists():
+    for path in glob.glob(os.path.join(models, '*', 'stages', '*GBTClassifier*', 'data')):
+        rows = parquetfile.ParquetFile.readPath(path)
+        trees = set(row['treeID'] for row in rows)
+        assert trees == set(range(10))
+        for row in rows:
+            node = row['nodeData']
+            assert len(node['impurityStats']) == 3
+            if node['leftChild'] == -1:
+                assert node['split']['leftCategoriesOrThreshold'] == []
+            else:
+                assert len(node['split']['leftCategoriesOrThreshold']) == 1
+        for path in glob.glob(os.path.join(os.path.dirname(path), 'treesMetadata')):
+            weights = [row['weights'] for row in parquetfile.ParquetFile.readPath(path)]
+            assert len(weights) == 10 and all(isinstance(weight, float) for weight in weights)
+
+
+def element(name, type=None, repetition=parquetfile.REQUIRED, converted=None, children=0):
+    fields = {3: repetition, 4: str.encode(name)}
+    if type is not None:
+        fields[1] = type
+    if converted is not None:
+        fields[6] = converted
+    if children:
+        fields[5] = children
+    return fields
+
+
+def test_rejects_unsupported_columns():
+    # INT64 is not read
+    with pytest.raises(ValueError):
+        parquetfile.Column([element('x', 2)])
+    # byte arrays are only read as UTF8 strings
+    with pytest.raises(ValueError):
+        parquetfile.Column([element('x', parquetfile.BYTE_ARRAY)])
+    # a repeated field outside of a LIST group
+    with pytest.raises(ValueError):
+        parquetfile.Column([element('x', parquetfile.INT32, parquetfile.REPEATED)])
+    # lists of lists
+    outer = element('x', repetition=parquetfile.OPTIONAL, converted=parquetfile.LIST, children=1)
+    inner = element('y', repetition=parquetfile.OPTIONAL, converted=parquetfile.LIST, children=1)
+    with pytest.raises(ValueError):
+        parquetfile.Column([outer, element('list', repetition=parquetfile.REPEATED, children=1), inner,
+                            element('list', repetition=parquetfile.REPEATED, children=1),
+                            element('element', parquetfile.DOUBLE, parquetfile.OPTIONAL)])
+    # a single-level list of doubles is read
+    column = parquetfile.Column([outer, element('list', repetition=parquetfile.REPEATED, children=1),
+                                 element('element', parquetfile.DOUBLE, parquetfile.OPTIONAL)])
+    assert column.repeated == 1 and column.maxDefinition == 3
@@ -1,125 +1,436 @@
-import sys
-import os
-import copy
 import json
-import numbers
+import gzip
+import itertools
 from hashlib import sha256 as H
 import random
-from collections import defaultdict
-from threading import Thread
 import time
+from collections import Counter, OrderedDict
+from threading import Lock
 import nacl.encoding
 import nacl.signing
-import blockchain
-import mergesplit_node
-import mergesplit_network
 import mergesplit_community
 import buildingblocks
+import codec
+
+# implements a bounded least-recently-used cache that is safe to share between threads
+# if ttl is given, entries also expire ttl after they were put, as measured by clock
+class LRUCache:
+
+    def __init__(self, capacity, ttl=None, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        # key -> value, or (value, expiry) if entries expire
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        # lookups that found a live entry, and lookups that did not
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cached value for key (or default), marking it as recently used
+    def get(self, key, default=None):
+        return self.getMany([key], default)[0]
+
+    # returns the cached value (or default) of each of keys, taking the lock once
+    def getMany(self, keys, default=None):
+        with self.lock:
+            now = self.clock() if self.ttl is not None else None
+            values = []
+            for key in keys:
+                value = self.entries.get(key, self)
+                if value is not self and now is not None:
+                    value, expiry = value
+                    if now >= expiry:
+                        del self.entries[key]
+                        value = self
+                if value is self:
+                    self.misses += 1
+                    values.append(default)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    values.append(value)
+            return values
+
+    # caches a value, evicting the least recently used entry when full
+    def put(self, key, value):
+        self.putMany([(key, value)])
+
+    # caches each (key, value) of items, taking the lock once
+    def putMany(self, items):
+        with self.lock:
+            expiry = self.clock() + self.ttl if self.ttl is not None else None
+            for (key, value) in items:
+                self.entries[key] = value if expiry is None else (value, expiry)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    # drops every entry
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # returns the fraction of lookups that hit (0 before any lookup)
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# implements a lock per id (community) that is safe to share between threads
+# several ids are taken with tryAcquire, which never blocks and takes them in id order, so two
+# callers after overlapping ids cannot deadlock and callers after disjoint ids never wait on each other
+class LockManager:
+
+    def __init__(self):
+        # id -> Lock, created on first use
+        self.locks = {}
+        self.lock = Lock()
+        # tryAcquire calls, those that failed because an id was held, and failures by the id found held
+        self.attempts = 0
+        self.contended = 0
+        self.contention = Counter()
+        # acquire calls that had to wait for a held id, and seconds spent waiting
+        self.waits = 0
+        self.waitTime = 0.0
+
+    def _lockFor(self, id):
+        lock = self.locks.get(id)
+        if lock is None:
+            with self.lock:
+                lock = self.locks.setdefault(id, Lock())
+        return lock
+
+    # takes every one of ids without blocking, in id order
+    # returns True holding all of them, or False holding none if any is held
+    def tryAcquire(self, ids):
+        held = []
+        for id in sorted(set(ids)):
+            lock = self._lockFor(id)
+            if not lock.acquire(blocking=False):
+                for other in reversed(held):
+                    other.release()
+                with self.lock:
+                    self.attempts += 1
+                    self.contended += 1
+                    self.contention[id] += 1
+                return False
+            held.append(lock)
+        with self.lock:
+            self.attempts += 1
+        return True
+
+    # takes id, waiting until it is released if held
+    def acquire(self, id):
+        lock = self._lockFor(id)
+        if lock.acquire(blocking=False):
+            return
+        start = time.monotonic()
+        lock.acquire()
+        with self.lock:
+            self.waits += 1
+            self.waitTime += time.monotonic() - start
+
+    # releases ids taken with tryAcquire or acquire
+    def release(self, ids):
+        for id in set(ids):
+            self.locks[id].release()
+
+    # returns whether id is currently held
+    def isLocked(self, id):
+        lock = self.locks.get(id)
+        return lock is not None and lock.locked()
+
+    # returns the fraction of tryAcquire calls that failed (0 before any call)
+    def contentionRate(self):
+        return self.contended / self.attempts if self.attempts else 0.0
+
+
+# implements an incremental JSON reader over a file, decoding one value at a time
+# so that large arrays can be consumed element by element without loading the whole file
+class JsonStream:
+
+    # characters read from the file at a time
+    chunkSize = 1 << 16
+    decoder = json.JSONDecoder()
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    # reads the next chunk into the buffer, dropping what was already consumed
+    def _fill(self):
+        chunk = self.file.read(JsonStream.chunkSize)
+        if not chunk:
+            self.eof = True
+            return
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    # returns the next non-whitespace character without consuming it ('' at the end of the file)
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\n\r':
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position:self.position+1]
+            self._fill()
+
+    # consumes the next non-whitespace character, which must be one of chars
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise json.JSONDecodeError('Expecting one of ' + repr(chars), self.buffer, self.position)
+        self.position += 1
+        return c
+
+    # decodes and consumes the next complete JSON value
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = JsonStream.decoder.raw_decode(self.buffer, self.position)
+                # a number ending at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    # iterates over the elements of the array starting at the current position
+    # the caller consumes each element (with value() or further parsing) before advancing
+    def elements(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+    # iterates over the keys of the object starting at the current position
+    # the caller consumes each key's value before advancing
+    def members(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
 
 
 # implements a utility class that permits SerDes operations, signing verification, IO parsing
 class Utils:
+
+    # decoded nacl verify keys, keyed by hex public key
+    verifyKeys = LRUCache(4096)
+    # signature verification results, keyed by (transaction number, signature, public key)
+    verifiedSignatures = LRUCache(1 << 16)
+    # encoding of transactions and blocks used for hashing, storage and logs
+    # (codec.JsonCodec() keeps the earlier JSON encoding; see there for what stays compatible)
+    codec = codec.BinaryCodec()
     
+    # keys of a legal transaction, input and output
+    transactionKeys = frozenset(['number', 'input', 'output', 'sig'])
+    inputKeys = frozenset(['number', 'output'])
+    outputKeys = frozenset(['value', 'pubkey'])
+    # JSON decodes numbers to these types
+    numberTypes = (int, float, bool)
+
     # utility method to validate legal transaction files
+    # compares key sets and exact types instead of testing each field, as this runs once per input transaction
     def validateLegalTransaction(transactionHash):
-        if not isinstance(transactionHash, dict):
-            return False
-        if ('number' not in transactionHash
-            or 'input' not in transactionHash
-            or 'output' not in transactionHash
-            or 'sig' not in transactionHash
-            or len(transactionHash) != 4):
+        if type(transactionHash) is not dict or transactionHash.keys() != Utils.transactionKeys:
             return False
-        if (not isinstance(transactionHash['input'], list)
-            or not isinstance(transactionHash['output'], list)
-            or not isinstance(transactionHash['number'], str)
-            or not isinstance(transactionHash['sig'], str)):
+        if (type(transactionHash['input']) is not list
+            or type(transactionHash['output']) is not list
+            or type(transactionHash['number']) is not str
+            or type(transactionHash['sig']) is not str):
             return False
         for inp in transactionHash['input']:
-            if (not isinstance(inp, dict)
-                or 'number' not in inp
-                or 'output' not in inp
-                or len(inp) != 2):
+            if type(inp) is not dict or inp.keys() != Utils.inputKeys or type(inp['number']) is not str:
                 return False
-            if (not isinstance(inp['output'], dict)
-                or 'value' not in inp['output']
-                or 'pubkey' not in inp['output']
-                or len(inp['output']) != 2):
-                return False
-            if (not isinstance(inp['number'], str)
-                or not isinstance(inp['output']['value'], numbers.Number)
-                or not isinstance(inp['output']['pubkey'], str)):
+            out = inp['output']
+            if (type(out) is not dict or out.keys() != Utils.outputKeys
+                or type(out['value']) not in Utils.numberTypes or type(out['pubkey']) is not str):
                 return False
         for out in transactionHash['output']:
-            if (not isinstance(out, dict) 
-                or not 'value' in out
-                or not 'pubkey' in out
-                or len(out) != 2):
-                return False
-            if (not isinstance(out['value'], numbers.Number)
-                or not isinstance(out['pubkey'], str)):
+            if (type(out) is not dict or out.keys() != Utils.outputKeys
+                or type(out['value']) not in Utils.numberTypes or type(out['pubkey']) is not str):
                 return False
         return True
 
+    # utility method to build a transaction from its JSON form
+    def transactionFromJson(t):
+        return buildingblocks.Transaction(t["number"], Utils.inputsFromJson(t["input"]),
+                                          Utils.outputsFromJson(t["output"]), t["sig"])
+
+    # utility method to convert a transaction to its JSON form
+    def transactionToJson(transaction):
+        return {"number": transaction.number, "input": Utils.inputsToJson(transaction.inp),
+                "output": Utils.outputsToJson(transaction.out), "sig": transaction.sig}
+
+    def inputsFromJson(inputs):
+        return tuple([buildingblocks.Input(inp["number"], inp["output"]["value"], inp["output"]["pubkey"])
+                      for inp in inputs])
+
+    def outputsFromJson(outputs):
+        return tuple([buildingblocks.Output(out["value"], out["pubkey"]) for out in outputs])
+
+    def inputsToJson(inputs):
+        return [{"number": inp.number, "output": {"value": inp.value, "pubkey": inp.pubkey}} for inp in inputs]
+
+    def outputsToJson(outputs):
+        return [{"value": out.value, "pubkey": out.pubkey} for out in outputs]
+
     def parseTransactions(pool):
-        transactions = []
-        for t in pool:
-            if Utils.validateLegalTransaction(t):
-                transaction = buildingblocks.Transaction(t["number"], t["input"], t["output"], t["sig"])
-                transactions.append(transaction)
-        return transactions
-    
+        return [Utils.transactionFromJson(t)
+                for t in pool if Utils.validateLegalTransaction(t)]
+
     # utility method to read in transactions from input file
+    # every community's pool is held in memory: communities all run from the start of a simulation, while
+    # their pools follow one another in the file, so only the parsing is incremental here
     def readTransactionFile(filename):
-        communities = []
-        with open(filename) as f:
-            data = json.load(f)
-            for community in data:
-                pool, keys = community["pool"], community["signingKeys"]
-                transactions = Utils.parseTransactions(pool)
-                communities.append(mergesplit_community.Community(network=None, id=-1, pool=transactions,
-                                                                  keys=keys, nodeList=None))
-        return communities
-    
+        return [mergesplit_community.Community(network=None, id=-1, pool=list(pool), keys=keys, nodeList=None)
+                for (keys, pool) in Utils.streamTransactionFile(filename)]
+
+    # utility method to incrementally read communities from an input file
+    # yields (signing keys, transactions) per community; transactions are parsed as they are read
+    # and must be consumed before the next community is requested
+    # accepts the JSON array written by datapipe.py, or JSON Lines where a {"signingKeys": [...]} line
+    # starts a community and each following line is one of its transactions, either possibly gzipped (.gz)
+    def streamTransactionFile(filename):
+        with (gzip.open(filename, 'rt') if filename.endswith('.gz') else open(filename)) as f:
+            head = f.read(JsonStream.chunkSize).lstrip()
+            f.seek(0)
+            if head.startswith('['):
+                stream = JsonStream(f)
+                for _ in stream.elements():
+                    yield from Utils._streamCommunity(stream)
+            else:
+                yield from Utils._streamLines(f)
+
+    # parses one community object of a JSON array input file
+    def _streamCommunity(stream):
+        keys, pool, streamed = None, [], False
+        for key in stream.members():
+            if key == 'signingKeys':
+                keys = stream.value()
+            elif key == 'pool' and keys is not None:
+                # keys already known: hand out transactions as they are parsed
+                transactions = Utils._streamPool(stream)
+                yield keys, transactions
+                for _ in transactions:
+                    pass
+                streamed = True
+            elif key == 'pool':
+                pool = list(Utils._streamPool(stream))
+            else:
+                stream.value()
+        if keys is None:
+            raise NameError('Community in input file has no signing keys')
+        if not streamed:
+            yield keys, iter(pool)
+
+    # parses the transaction array of a community, skipping illegal transactions
+    def _streamPool(stream):
+        for _ in stream.elements():
+            t = stream.value()
+            if Utils.validateLegalTransaction(t):
+                yield Utils.transactionFromJson(t)
+
+    # parses a JSON Lines input file
+    def _streamLines(f):
+        values = (json.loads(line) for line in f if line.strip())
+        # the header line of the next community, found while reading the previous one's transactions
+        header = [next(values, None)]
+        while header[0] is not None:
+            if not (type(header[0]) is dict and 'signingKeys' in header[0]):
+                raise NameError('Transaction read before the signing keys of its community')
+            transactions = Utils._streamLinePool(values, header)
+            yield header[0]['signingKeys'], transactions
+            for _ in transactions:
+                pass
+
+    # parses the transaction lines of a community up to the next header line, skipping illegal transactions
+    def _streamLinePool(values, header):
+        pool, header[0] = header[0].get('pool', []), None
+        for t in itertools.chain(pool, values):
+            if type(t) is dict and 'signingKeys' in t:
+                header[0] = t
+                return
+            if Utils.validateLegalTransaction(t):
+                yield Utils.transactionFromJson(t)
+
     # utility method to serialize a transaction
     def serializeTransaction(transaction):
-        toSerialize = [transaction.number, transaction.inp, transaction.out, transaction.sig]
-        wrapped = {'data': toSerialize}
-        data = json.dumps(wrapped)
-        return data
+        return Utils.codec.encodeTransaction(transaction)
     
     # utility method to serialize a block
     def serializeBlock(block):
-        toSerialize = [block.tx, block.prev]
-        wrapped = {'data': toSerialize}
-        data = json.dumps(wrapped)
-        return data
+        return Utils.codec.encodeBlock(block)
+
+    # utility method to serialize the part of a block that is hashed
+    # the merkle root commits to every transaction in the block
+    def serializeBlockHeader(block):
+        return Utils.codec.encodeHeader(block.getMerkleRoot(), block.prev)
      
     # utility method to deserialize a block
     def deserializeBlock(block):
-        wrapped = json.loads(block)
-        wrapped = wrapped['data']
-        return buildingblocks.Block(wrapped[0], wrapped[1])
+        return Utils.codec.decodeBlock(block)
         
     # utility method to deserialize a transaction
     def deserializeTransaction(tx):
-        wrapped = json.loads(tx)
-        wrapped = wrapped['data']
-        return buildingblocks.Transaction(wrapped[0], wrapped[1], wrapped[2], wrapped[3])
+        return Utils.codec.decodeTransaction(tx)
     
     # utility method to generate random 256 bit nonces
     def generateNonce(length=256):
         return ''.join([str(random.randint(0,9)) for i in range(length)])
 
+    # utility method to fetch a decoded verify key for a hex public key
+    def getVerifyKey(pubkey):
+        verifyKey = Utils.verifyKeys.get(pubkey)
+        if verifyKey is None:
+            verifyKey = nacl.signing.VerifyKey(str.encode(pubkey), encoder=nacl.encoding.HexEncoder)
+            Utils.verifyKeys.put(pubkey, verifyKey)
+        return verifyKey
+
     # utility method to verify if public key can validate a message given its signature
     def verifyWithPublicKey(pubkey, message, signature):
         try:
-            verifyKey = str.encode(pubkey)
-            verifyKey = nacl.signing.VerifyKey(verifyKey, encoder=nacl.encoding.HexEncoder)
-            sig = str.encode(signature)
-            bytesMessage = str.encode(str.encode(message).hex())
+            verifyKey = Utils.getVerifyKey(pubkey)
+            if isinstance(message, str):
+                message = str.encode(message)
             # verify the message and signature using the public key
-            verifyKey.verify(bytesMessage, sig, encoder=nacl.encoding.HexEncoder)
+            verifyKey.verify(message, bytes.fromhex(signature))
         except:
             return False
-        return True
\ No newline at end of file
+        return True
+
+    # utility method to verify a transaction's signature by pubkey
+    # results are remembered only when the transaction number commits to the signed message,
+    # so a later transaction reusing the number and signature must carry the same message
+    def verifyTransaction(pubkey, transaction):
+        message = transaction.getMessage()
+        committed = H(message + str.encode(transaction.sig)).hexdigest() == transaction.number
+        key = (transaction.number, transaction.sig, pubkey)
+        if committed:
+            verified = Utils.verifiedSignatures.get(key)
+            if verified is not None:
+                return verified
+        verified = Utils.verifyWithPublicKey(pubkey, message, transaction.sig)
+        if committed:
+            Utils.verifiedSignatures.put(key, verified)
+        return verified